@@ -1,5 +1,5 @@
 # USAGE: ./cgenff_charmm2gmx.py DRUG drug.mol2 drug.str charmm36.ff
-# Tested with Python 2.7.3. Requires numpy and networkx
+# Tested with Python 2.7.3. Requires numpy (and networkx for atomgroup.to_networkx() only)
 
 # Copyright (C) 2014 E. Prabhu Raman prabhu@outerbanks.umaryland.edu
 #
@@ -21,7 +21,7 @@
 # The program needs four inputs:
 #   (1) The first argument (resname) is found in the RESI entry in the CHARMM stream file; for example
 #       RESI DRUG         0.000  ! here DRUG is the resname
-#   (2) drug.mol2 is the .mol2 which you supplied to ParamChem
+#   (2) drug.mol2 is the .mol2 which you supplied to ParamChem (the first molecule of a multi-molecule file)
 #   (3) drug.str contains the topology entry and CGenFF parameters that ParamChem generates for you
 #   (4) charmm36.ff should contain the CHARMM force-field in GROMACS format
 #       Download it from: http://mackerell.umaryland.edu/CHARMM_ff_params.html
@@ -30,22 +30,115 @@
 # The program will generate 4 output files ("DRUG" is converted to lowercase and the files are named accordingly):
 #   (1) drug.itp - contains GROMACS itp
 #   (2) drug.prm - contains parameters obtained from drug.str which are converted to GROMACS format and units
+#       (the atom types, 1-4 pair types and NBFIX of drug.str that are not in the force field come first)
 #   (3) drug.top - A Gromacs topology file which incorporates (1) and (2)
 #   (4) drug_ini.pdb - Coordinates of the molecule obtained from drug.mol2
 
 # The program has been tested only on CHARMM stream files containing topology and parameters of a single molecule.
 
+# BATCH MODE: ./cgenff_charmm2gmx.py --batch jobs.txt charmm36.ff [nproc]
+# converts many molecules against the same force field, loaded once, with nproc processes (default: all cores).
+# jobs.txt has one molecule per line: "RESNAME drug.mol2 drug.str [outdir]"; a directory holding drug.str/drug.mol2
+# pairs can be given instead. The paths of jobs.txt, outdir included, are relative to jobs.txt. The outputs of
+# drug.str go to outdir (default: ./drug, in the current directory) and the status of every job is written
+# to batch_summary.txt; a molecule that fails does not stop the batch. Two jobs with the same name (drug) or
+# outdir are refused before anything is converted.
+
+# The bonded parameters of every bond, angle, dihedral and improper are looked up in the force field
+# and drug.prm like grompp does (including the X wildcards of the dihedrals): a WARNING is printed for
+# the interactions without parameters or with several equally specific wildcard matches.
+# The parameters of drug.str that are already in the force field (see NOTE3 below) are counted, and a
+# WARNING is printed for those with different values; with --dedup the duplicates are left out of drug.prm.
+
+# LIBRARY: the conversion can be run from Python, e.g. by a workflow engine converting many molecules
+# in one process: the force field is loaded once and nothing is written unless asked:
+#   from cgenff_charmm2gmx import convert
+#   c = convert("DRUG","drug.mol2","drug.str","charmm36.ff")   # c.itp, c.prm, c.top, c.pdb (texts)
+#   c.write("outdir")
+
+# ARCHIVING: with --gzip (before the other arguments) the output files are written gzip-compressed
+# (drug.itp.gz, ...). GROMACS does not read compressed topologies: gunzip them before use.
+
+# STARTUP: numpy and networkx are imported only when needed, so that printing the usage stays under
+# 100 ms; python test_cgenff_charmm2gmx.py checks it.
+
 import string
 import re
 import sys
 import os
-import numpy as np
-import networkx as nx
+import cPickle
+import gzip
+import hashlib
+
+#-----------------------------------------------------------------------
+class lazymodule:
+    """
+    A module imported on its first use: the runs that do not need it (e.g.
+    printing the usage) do not pay for its import
+    """
+    def __init__(self,name):
+        self.__dict__["name"] = name
+        self.__dict__["module"] = None
+    def __getattr__(self,attr):
+        if self.module is None:
+            self.__dict__["module"] = __import__(self.name)
+        return getattr(self.module,attr)
+
+np = lazymodule("numpy")
+
+# compiled index of the force-field tables, see load_gmx_ffindex()
+FFINDEX_VERSION = 1
+FFINDEX_DIR = os.path.join(os.path.expanduser("~"),".cache","cgenff_charmm2gmx")
+# residue index of the .rtp/.hdb/.tdb files, see load_residue_index()
+RESINDEX_VERSION = 2
+
+# [ name ] line of an .rtp or .tdb file, and the names of the sub-sections of their residues
+rtp_residue_re = re.compile(r"^[ \t]*\[ *([^\] ]+) *\]", re.M)
+rtp_sections = [ "atoms", "bonds", "impropers", "dihedrals", "exclusions", "cmap" ]
+tdb_sections = [ "replace", "add", "delete", "impropers", "dihedrals" ]
+
+# section keywords of CHARMM parameter files (first 4 letters)
+charmm_prm_sections = [ "BOND", "ANGL", "DIHE", "IMPR", "CMAP", "NONB", "HBON", "NBFI" ]
+charmm_bonded_sections = [ "BOND", "ANGL", "DIHE", "IMPR" ]
+charmm_prm_natoms = { "BOND":2, "ANGL":3, "DIHE":4, "IMPR":4, "NONB":1, "NONBONDED14":1, "NBFI":2 }
+
+# angle types with theta0 above (deg) are linear: no dihedral across them, e.g. a triple bond
+linear_angle_cutoff = 179.9
+
+# CHARMM -> GROMACS units of the parameters, for each CHARMM section:
+# GROMACS section, function type, factor of each CHARMM column, order of the GROMACS columns
+# (factors of 2: CHARMM energies are K*(x-x0)**2, GROMACS ones 0.5*K*(x-x0)**2)
+kcal2kJ = 4.18400
+rmin2sigma = 0.1/2.0**(1.0/6.0)    # Lennard-Jones Rmin [A] -> sigma [nm]
+charmm2gmx_units = {
+    # Kb [kcal/mol/A**2], b0 [A]            -> b0 [nm], kb [kJ/mol/nm**2]
+    "BOND": ("bondtypes",1,[2.0*kcal2kJ/(0.1)**2,0.1],[1,0]),
+    # Ktheta [kcal/mol/rad**2], theta0 [deg], Kub [kcal/mol/A**2], S0 [A] -> theta0, ktheta, ub0, kub
+    "ANGL": ("angletypes",5,[2.0*kcal2kJ,1.0,2.0*kcal2kJ/(0.1)**2,0.1],[1,0,3,2]),
+    # Kchi [kcal/mol], n, delta [deg]       -> phi0, kphi [kJ/mol], mult
+    "DIHE": ("dihedraltypes",9,[kcal2kJ,1.0,1.0],[2,0,1]),
+    # Kpsi [kcal/mol/rad**2], psi0 [deg]    -> phi0, kphi [kJ/mol/rad**2]
+    "IMPR": ("dihedraltypes",2,[2.0*kcal2kJ,1.0],[1,0]),
+    # -Emin [kcal/mol], Rmin/2 [A]          -> sigma [nm], epsilon [kJ/mol]
+    "NONB": ("atomtypes",1,[kcal2kJ,2.0*rmin2sigma],[1,0]),
+    "NONBONDED14": ("pairtypes",1,[kcal2kJ,2.0*rmin2sigma],[1,0]),
+    # -Emin [kcal/mol], Rmin [A]            -> sigma [nm], epsilon [kJ/mol]
+    "NBFI": ("nonbond_params",1,[kcal2kJ,rmin2sigma],[1,0]),
+}
+
+# atomic number from the mass, for the [ atomtypes ] of new types
+element_masses = [ (1.008,1), (4.0026,2), (6.94,3), (10.81,5), (12.011,6), (14.007,7), (15.999,8),
+        (18.998,9), (20.180,10), (22.990,11), (24.305,12), (26.982,13), (28.085,14), (30.974,15),
+        (32.06,16), (35.45,17), (39.098,19), (39.948,18), (40.078,20), (54.938,25), (55.845,26),
+        (58.693,28), (58.933,27), (63.546,29), (65.38,30), (78.971,34), (79.904,35), (85.468,37),
+        (112.41,48), (126.90,53), (132.91,55), (137.33,56) ]
 
 #=================================================================================================================
 def check_versions(str_filename,ffdoc_filename):
     f = open(str_filename, 'r')
-    for line in f.readlines():
+    for line in f:
+        if not line.startswith("*"):
+            break   # the version is in the title at the top of the stream file
         if line.startswith("* For use with CGenFF version"):
             entry = re.split('\s+', string.lstrip(line))
             print "--Version of CGenFF detected in ",str_filename,":",entry[6]
@@ -107,66 +200,696 @@ def read_gmx_anglpars(filename):
 
     return anglpars
 #-----------------------------------------------------------------------
-def get_charmm_rtp_lines(filename,molname):
-    foundmol=0
-    store=0
-    rtplines=[]
-    f = open(filename, 'r')
-    section="NONE"
-    for line in f.readlines():
-        if(store==1) and line.startswith("RESI"):
-            store=0
+def read_gmx_sections(filename,defines):
+    """
+    Reads all the [ section ] tables of a GROMACS force-field file in one pass
+    Comments are stripped, continuation lines are joined and #ifdef/#ifndef/
+    #else/#endif blocks are resolved with defines (a dict updated in place by
+    #define and #undef). #include lines are ignored.
 
-        if line.startswith("RESI"):
-            entry = re.split('\s+', string.lstrip(line))
-            rtfmolname=entry[1]
-            if(rtfmolname == molname):
-                store=1
+    Returns a dict: section name -> list of entries (tuples of strings)
+    """
+    f = open(filename, 'r')
+    sections = parse_gmx_sections(f,defines)
+    f.close()
+    return sections
+#-----------------------------------------------------------------------
+def parse_gmx_sections(lines,defines):
+    """
+    Same as read_gmx_sections() for the lines of a force-field file
+    """
+    sections = {}
+    rows = None
+    skip = []   # one flag per open #ifdef/#ifndef block
+    cont = ""
+    for line in lines:
+        line = line.split(";",1)[0].strip()
+        if line.endswith("\\"):
+            cont = cont + line[:-1] + " "
+            continue
+        line = cont + line
+        cont = ""
+        if not line:
+            continue
+        if line.startswith("#"):
+            entry = line.split()
+            if entry[0] == "#ifdef":
+                skip.append(entry[1] not in defines)
+            elif entry[0] == "#ifndef":
+                skip.append(entry[1] in defines)
+            elif entry[0] == "#else":
+                skip[-1] = not skip[-1]
+            elif entry[0] == "#endif":
+                skip.pop()
+            elif True in skip:
+                continue
+            elif entry[0] == "#define":
+                defines[entry[1]] = string.join(entry[2:])
+            elif entry[0] == "#undef":
+                defines.pop(entry[1],None)
+            continue
+        if True in skip:
+            continue
+        if line.startswith("["):
+            rows = sections.setdefault(line.strip("[] \t"),[])
+        elif rows is not None:
+            rows.append(tuple(line.split()))
+    return sections
+#-----------------------------------------------------------------------
+def get_file_stamp(filename):
+    st = os.stat(filename)
+    return (st.st_mtime,st.st_size)
+#-----------------------------------------------------------------------
+def read_index(indexfile):
+    """
+    Returns the pickled index indexfile, or {} if it cannot be read
+    """
+    try:
+        f = open(indexfile, 'rb')
+        index = cPickle.load(f)
+        f.close()
+    except Exception:
+        index = {}
+    return index
+#-----------------------------------------------------------------------
+def write_index(indexfile,index,what):
+    """
+    Writes the pickled index to indexfile, atomically: concurrent runs may
+    share it. Prints a WARNING (what being the kind of index) on failure
+    """
+    try:
+        indexdir = os.path.dirname(indexfile)
+        if(indexdir and not os.path.isdir(indexdir)):
+            os.makedirs(indexdir)
+        tmpfile = "%s.%d" % (indexfile,os.getpid())
+        f = open(tmpfile, 'wb')
+        cPickle.dump(index,f,cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmpfile,indexfile)
+    except (IOError,OSError):
+        print "WARNING: could not write the %s %s" % (what,indexfile)
+#-----------------------------------------------------------------------
+def get_gmx_ffindex_file(parent):
+    """
+    Returns the index file of the force-field parent file parent: its name
+    and a hash of its absolute path, so that two paths never share an index
+    """
+    parent = os.path.abspath(parent)
+    return os.path.join(FFINDEX_DIR,"%s_%s.pkl" % (os.path.basename(parent),hashlib.md5(parent).hexdigest()))
+#-----------------------------------------------------------------------
+def load_gmx_ffindex(ffdir,ffparentfile):
+    """
+    Returns the [ section ] tables (see read_gmx_sections) of every file
+    included by ffparentfile, as a list of (filename, sections) in include order
 
-        if line.startswith("END"):
-            store=0
+    The tables are kept in a compiled index under FFINDEX_DIR, keyed by the
+    path, mtime and size of each file: a file is only parsed again when it
+    changed, so loading the same force field many times is cheap.
+    """
+    parent = os.path.abspath(os.path.join(ffdir,ffparentfile))
+    indexfile = get_gmx_ffindex_file(parent)
+    index = read_index(indexfile)
+    changed = False
+    if(index.get("version") != FFINDEX_VERSION or index["parent"][0] != get_file_stamp(parent)):
+        # the defines of the parent file apply to all the included files
+        defines = {}
+        read_gmx_sections(parent,defines)
+        index = {"version":FFINDEX_VERSION, "parent":(get_file_stamp(parent),defines), "files":{}}
+        changed = True
+
+    fftables = []
+    for filename in get_filelist_from_gmx_forcefielditp(ffdir,ffparentfile):
+        filename = os.path.abspath(filename)
+        stamp = get_file_stamp(filename)
+        if(filename not in index["files"] or index["files"][filename][0] != stamp):
+            sections = read_gmx_sections(filename,dict(index["parent"][1]))
+            for name in sections.keys():
+                # stored pickled: loading the index only reads a few strings,
+                # a section is unpickled when first asked for
+                sections[name] = cPickle.dumps(sections[name],cPickle.HIGHEST_PROTOCOL)
+            index["files"][filename] = (stamp,sections)
+            changed = True
+        fftables.append((filename,dict(index["files"][filename][1])))
+
+    if(changed):
+        write_index(indexfile,index,"force-field index")
+    return fftables
+#-----------------------------------------------------------------------
+def update_gmx_ffindex(ffdir,ffparentfile,filename,sections):
+    """
+    Sets the tables of filename, one of the files of the index of
+    load_gmx_ffindex(), to sections (see read_gmx_sections) after filename
+    was modified by the caller, so that it is not parsed again. With
+    sections None, filename is parsed again by the next load
+    """
+    indexfile = get_gmx_ffindex_file(os.path.abspath(os.path.join(ffdir,ffparentfile)))
+    index = read_index(indexfile)
+    if(index.get("version") != FFINDEX_VERSION):
+        return
+    filename = os.path.abspath(filename)
+    if sections is None:
+        index["files"].pop(filename,None)
+    else:
+        sections = dict([(name,cPickle.dumps(rows,cPickle.HIGHEST_PROTOCOL)) for name,rows in sections.items()])
+        index["files"][filename] = (get_file_stamp(filename),sections)
+    write_index(indexfile,index,"force-field index")
+#-----------------------------------------------------------------------
+def get_gmx_section(fftables,name):
+    """
+    Returns the entries of section name from all the files of fftables
+    (see load_gmx_ffindex), in include order
+    """
+    rows = []
+    for filename,sections in fftables:
+        if name in sections:
+            if isinstance(sections[name],str):
+                sections[name] = cPickle.loads(sections[name])
+            rows.extend(sections[name])
+    return rows
+#-----------------------------------------------------------------------
+def get_gmx_anglpars(fftables):
+    """
+    Same as read_gmx_anglpars() for the tables returned by load_gmx_ffindex()
+    """
+    anglpars = []
+    for entry in get_gmx_section(fftables,"angletypes"):
+        anglpars.append([entry[0],entry[1],entry[2],float(entry[4])])
+    return anglpars
+#-----------------------------------------------------------------------
+def get_rtp_blocks(data,subsections=rtp_sections):
+    """
+    Returns the residue blocks of the text of an .rtp (or .tdb) file: a dict
+    name -> (start,end) byte offsets, a block ending where the next one starts.
+    The [ name ] lines of subsections are part of a block
+    """
+    starts = [(m.start(),m.group(1)) for m in rtp_residue_re.finditer(data)
+            if m.group(1).lower() not in subsections]
+    blocks = {}
+    for i,(start,name) in enumerate(starts):
+        if(i+1 < len(starts)):
+            blocks[name] = (start,starts[i+1][0])
+        else:
+            blocks[name] = (start,len(data))
+    return blocks
+#-----------------------------------------------------------------------
+def get_hdb_blocks(data):
+    """
+    Returns the residue entries of the text of an .hdb file: a dict
+    name -> (start,end) byte offsets. An entry is a "name n" line followed
+    by n lines
+    """
+    blocks = {}
+    lines = data.splitlines(True)
+    pos = 0
+    i = 0
+    while i < len(lines):
+        entry = lines[i].split()
+        start = pos
+        pos = pos + len(lines[i])
+        i = i+1
+        if(len(entry) < 2 or entry[0].startswith(";")):
+            continue
+        for k in range(int(entry[1])):
+            pos = pos + len(lines[i])
+            i = i+1
+        blocks[entry[0]] = (start,pos)
+    return blocks
+#-----------------------------------------------------------------------
+def get_tdb_blocks(data):
+    """
+    Returns the residue index of the .tdb file data (see get_rtp_blocks)
+    """
+    return get_rtp_blocks(data,tdb_sections)
+#-----------------------------------------------------------------------
+def get_residue_indexer(filename,get_blocks=None):
+    """
+    Returns get_blocks, or the function indexing filename by its extension
+    if None (see load_residue_index)
+    """
+    if get_blocks is not None:
+        return get_blocks
+    elif filename.endswith(".hdb"):
+        return get_hdb_blocks
+    elif filename.endswith(".tdb"):
+        return get_tdb_blocks
+    return get_rtp_blocks
+#-----------------------------------------------------------------------
+def load_residue_index(filename,get_blocks=None):
+    """
+    Returns the residue index of an .rtp, .hdb or .tdb file: a dict
+    name -> (start,end) byte offsets (see get_rtp_blocks, get_hdb_blocks),
+    or the index of get_blocks(data) for other files
 
-        if(store==1):
-            rtplines.append(line)
+    The index is kept in the sidecar file filename.idx and only rebuilt
+    when the mtime or size of filename changed, or when it was built by
+    another function than get_blocks (by its name)
+    """
+    get_blocks = get_residue_indexer(filename,get_blocks)
+    index = read_index(filename + ".idx")
+    if(index.get("version") == RESINDEX_VERSION and index["stamp"] == get_file_stamp(filename)
+            and index["kind"] == get_blocks.__name__):
+        return index["blocks"]
 
-    return rtplines
+    f = open(filename, 'r')
+    data = f.read()
+    f.close()
+    blocks = get_blocks(data)
+    save_residue_index(filename,blocks,get_blocks)
+    return blocks
 #-----------------------------------------------------------------------
-def get_charmm_prm_lines(filename):
-    foundmol=0
-    store=0
-    prmlines=[]
+def save_residue_index(filename,blocks,get_blocks=None):
+    """
+    Saves blocks, built by get_blocks, as the index of filename (see
+    load_residue_index), e.g. after the caller modified filename and updated
+    the offsets
+    """
+    kind = get_residue_indexer(filename,get_blocks).__name__
+    index = {"version":RESINDEX_VERSION, "stamp":get_file_stamp(filename), "kind":kind, "blocks":blocks}
+    write_index(filename + ".idx",index,"residue index")
+#-----------------------------------------------------------------------
+def read_residue(filename,name,blocks=None):
+    """
+    Returns the residue name of an .rtp, .hdb or .tdb file, read with a
+    single seek through load_residue_index() (or the index blocks it
+    returned, when reading many residues), or None if it is not there:
+      .rtp: dict subsection -> entries, the "atoms" as (name,type,charge,cgnr)
+      .hdb: list of entries (nh,type,hydrogen,atoms...)
+      .tdb: dict subsection (lowercase) -> entries, the "add" ones as
+            (hydrogen entry, atom entry)
+    Entries are tuples of strings
+
+    USAGE: read_residue("charmm36.ff/merged.rtp","PT2")["cmap"]
+    """
+    if blocks is None:
+        blocks = load_residue_index(filename)
+    if name not in blocks:
+        return None
+    start,end = blocks[name]
     f = open(filename, 'r')
-    section="NONE"
-    for line in f.readlines():
+    f.seek(start)
+    lines = f.read(end-start).splitlines()
+    f.close()
 
-        if line.startswith("END"):
-            section="NONE"
-            store=0
+    if filename.endswith(".hdb"):
+        return [tuple(line.split()) for line in lines[1:] if line.strip()]
+    residue = {}
+    rows = None
+    for line in lines[1:]:
+        line = line.split(";",1)[0].strip()
+        if not line:
+            continue
+        if line.startswith("["):
+            rows = residue.setdefault(line.strip("[] \t").lower(),[])
+        elif rows is not None:
+            rows.append(tuple(line.split()))
+    if "atoms" in residue and not filename.endswith(".tdb"):
+        residue["atoms"] = [(e[0],e[1],float(e[2]),int(e[3])) for e in residue["atoms"]]
+    if "add" in residue:
+        residue["add"] = zip(residue["add"][0::2],residue["add"][1::2])
+    return residue
+#=================================================================================================================
+# lines of a GROMACS topology that the preprocessor or the section scan must see
+gmx_directive_re = re.compile(r"^[ \t]*([\[#].*)$", re.M)
 
-        if(store):
-            prmlines.append(line)
+# sections that are not part of the preceding [ moleculetype ]
+gmx_global_sections = [ "defaults", "system", "molecules", "nonbond_params", "implicit_genborn_params" ]
+
+# number of atoms of an entry in the interaction sections of a [ moleculetype ]
+gmx_interaction_natoms = { "bonds":2, "pairs":2, "pairs_nb":2, "angles":3, "dihedrals":4, "cmap":5,
+        "constraints":2, "settles":1, "position_restraints":1, "dihedral_restraints":4,
+        "distance_restraints":2, "orientation_restraints":2, "angle_restraints":4 }
+
+class gmxtopology:
+    """
+    A lazy reader for GROMACS topologies (.top/.itp)
+
+    The topology and its #include files are preprocessed like grompp does
+    (#include, #define, #undef, #ifdef, #ifndef, #else, #endif; macros are
+    not expanded): one scan of each file records the byte ranges of every
+    [ section ] that is active with the given defines. A section is read and
+    tokenized only when it is asked for, so a question about one molecule
+    does not parse the whole system.
+
+    USAGE: t = gmxtopology("topol.top",{"POSRES_WATER":""})
+           t.molecules                                  # [ (name,count) ] of [ molecules ]
+           t.get_atoms("Protein_chain_A")['charge'].sum()
+           atoms,funct = t.get_interactions("Protein_chain_A","dihedrals")
+    """
 
-        if line.startswith("read para"):
-            section="PRM"
-            store=1
+    def __init__(self,filename,defines={},includedirs=[]):
+        self.filename = filename
+        self.defines = dict(defines)
+        self.includedirs = list(includedirs)
+        if "GMXLIB" in os.environ:
+            self.includedirs = self.includedirs + os.environ["GMXLIB"].split(os.pathsep)
+        self.moleculetypes = [] # names, in order of definition
+        self.ranges = {}        # (moleculetype or None, section) -> [ (filename,start,end) ]
+        self.cache = {}         # key -> rows of the sections read so far
+        self.atoms = {}         # key -> get_atoms() arrays
+        self.skip = []          # one flag per open #ifdef/#ifndef block
+        self.key = None
+        self.segment = None
+        self.scan_file(os.path.abspath(filename))
+        if(len(self.skip) != 0):
+            raise ValueError("gmxtopology: missing #endif in %s" % filename)
+        for i in range(0,len(self.moleculetypes)):
+            self.moleculetypes[i] = self.read_rows(self.ranges.get((i,"moleculetype"),[]))[0][0]
+
+        self.system = string.join([string.join(entry) for entry in self.get_rows(None,"system")],"\n")
+        self.molecules = [(entry[0],int(entry[1])) for entry in self.get_rows(None,"molecules")]
 
+    #-----------------------------------------------------------------------
+    def find_include(self,name,parentdir):
+        for topdir in [parentdir] + self.includedirs:
+            filename = os.path.join(topdir,name)
+            if os.path.isfile(filename):
+                return os.path.abspath(filename)
+        raise IOError("gmxtopology: #include file not found: %s" % name)
+    #-----------------------------------------------------------------------
+    def close_segment(self,end):
+        if(self.segment is not None and self.key is not None and True not in self.skip):
+            filename,start = self.segment
+            if(end > start):
+                self.ranges.setdefault(self.key,[]).append((filename,start,end))
+        self.segment = None
+    #-----------------------------------------------------------------------
+    def scan_file(self,filename):
+        """
+        Preprocesses filename and records the byte ranges of the sections.
+        Only the directive and [ section ] lines are looked at.
+        """
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        self.segment = (filename,0)
+        for match in gmx_directive_re.finditer(data):
+            self.close_segment(match.start())
+            line = match.group(1).split(";")[0].strip()
+            entry = line.split()
+            if(line[0] == "["):
+                name = line.strip("[] \t")
+                if(True in self.skip):
+                    pass
+                elif(name == "moleculetype"):
+                    self.moleculetypes.append(None)    # name known when the section is read
+                    self.key = (len(self.moleculetypes)-1,name)
+                elif(len(self.moleculetypes) == 0 or name.endswith("types") or name in gmx_global_sections):
+                    self.key = (None,name)
+                else:
+                    self.key = (len(self.moleculetypes)-1,name)
+            elif(entry[0] == "#ifdef"):
+                self.skip.append(entry[1] not in self.defines)
+            elif(entry[0] == "#ifndef"):
+                self.skip.append(entry[1] in self.defines)
+            elif(entry[0] == "#else"):
+                self.skip[-1] = not self.skip[-1]
+            elif(entry[0] == "#endif"):
+                self.skip.pop()
+            elif(True in self.skip):
+                pass
+            elif(entry[0] == "#define"):
+                self.defines[entry[1]] = string.join(entry[2:])
+            elif(entry[0] == "#undef"):
+                self.defines.pop(entry[1],None)
+            elif(entry[0] == "#include"):
+                name = line[len("#include"):].strip().strip("\"<>")
+                self.scan_file(self.find_include(name,os.path.dirname(filename)))
+            self.segment = (filename,match.end())
+        self.close_segment(len(data))
+    #-----------------------------------------------------------------------
+    def read_rows(self,ranges):
+        rows = []
+        for filename,start,end in ranges:
+            f = open(filename, 'rb')
+            f.seek(start)
+            for line in f.read(end-start).splitlines():
+                entry = line.split(";")[0].split()
+                if(len(entry) > 0):
+                    rows.append(entry)
+            f.close()
+        return rows
+    #-----------------------------------------------------------------------
+    def get_key(self,moleculetype,section):
+        if moleculetype is None:
+            return (None,section)
+        if moleculetype not in self.moleculetypes:
+            raise KeyError("gmxtopology: no moleculetype %s in %s" % (moleculetype,self.filename))
+        # the last definition wins, as in grompp
+        return (len(self.moleculetypes)-1-self.moleculetypes[::-1].index(moleculetype),section)
+    #-----------------------------------------------------------------------
+    def get_sections(self,moleculetype=None):
+        """
+        Returns the names of the sections of moleculetype (None: force-field
+        and system sections), without reading them
+        """
+        key = self.get_key(moleculetype,None)[0]
+        return sorted(set([section for i,section in self.ranges.keys() if i == key]))
+    #-----------------------------------------------------------------------
+    def get_rows(self,moleculetype,section):
+        """
+        Returns the entries (lists of strings, comments stripped) of section
+        of moleculetype; moleculetype None for force-field and system sections
+        """
+        key = self.get_key(moleculetype,section)
+        if key not in self.cache:
+            self.cache[key] = self.read_rows(self.ranges.get(key,[]))
+        return self.cache[key]
+    #-----------------------------------------------------------------------
+    def get_atoms(self,moleculetype):
+        """
+        Returns the [ atoms ] of moleculetype as a numpy structured array
+        (nr, type, resnr, residue, atom, cgnr, charge, mass). Missing masses
+        are taken from [ atomtypes ].
+        """
+        key = self.get_key(moleculetype,"atoms")
+        if key in self.atoms:
+            return self.atoms[key]
+        rows = self.get_rows(moleculetype,"atoms")
+        atoms = np.zeros(len(rows),dtype=[('nr','i4'),('type','S8'),('resnr','i4'),('residue','S8'),
+                ('atom','S8'),('cgnr','i4'),('charge','f8'),('mass','f8')])
+        masses = None
+        for i,entry in enumerate(rows):
+            if(len(entry) > 7):
+                mass = float(entry[7])
+            else:
+                if masses is None:
+                    masses = dict([(e[0],float(e[-5])) for e in self.get_rows(None,"atomtypes")])
+                mass = masses.get(entry[1],np.nan)
+            atoms[i] = (int(entry[0]),entry[1],int(entry[2]),entry[3],entry[4],int(entry[5]),float(entry[6]),mass)
+        self.atoms[key] = atoms
+        return atoms
+    #-----------------------------------------------------------------------
+    def get_interactions(self,moleculetype,section):
+        """
+        Returns (atoms,funct) for an interaction section of moleculetype
+        (bonds, pairs, angles, dihedrals, cmap...): atoms is an (n,k) int
+        array of the atom numbers as in the file (starting at 1), funct the
+        (n,) array of function types
+        """
+        natoms = gmx_interaction_natoms[section]
+        rows = self.get_rows(moleculetype,section)
+        table = np.array([entry[:natoms+1] for entry in rows],dtype=np.int32).reshape(len(rows),natoms+1)
+        return table[:,:natoms],table[:,natoms]
 
+#=================================================================================================================
+def get_linear_angltypes(anglpars,cutoff):
+    """
+    Returns the set of (i,j,k) angle types with theta0 > cutoff, stored in
+    both orientations so that a lookup does not need to canonicalize
+    """
+    linear = set()
+    for ai,aj,ak,eq in anglpars:
+        if(eq > cutoff):
+            linear.add((ai,aj,ak))
+            linear.add((ak,aj,ai))
+    return linear
+#-----------------------------------------------------------------------
+def iter_charmm_stream(filename):
+    """
+    Reads a CHARMM stream file in a single pass over the file and yields
+    (block, key, line) for each line that is not blank, a title or a comment:
+      block is "RTF" inside a read rtf block, "PARA" inside a read para block
+            and None elsewhere
+      key   is the current RESI name in a RTF block (None outside a RESI) and
+            the current parameter section (ATOM, BOND, ANGL, DIHE, IMPR,
+            CMAP, NONB, HBON, NBFI) in a PARA block
+      line  has its comment and trailing blanks stripped
+    The read/END lines themselves are not yielded.
+    """
+    block = None
+    key = None
+    f = open(filename, 'r')
+    for line in f:
+        line = line.split('!')[0].rstrip()
+        if len(line) == 0 or line.lstrip()[0] == '*':
+            continue
+        entry = line.split()
+        word = entry[0].upper()
+        if(word == "READ" and len(entry) > 1):
+            if entry[1].upper().startswith("RTF"):
+                block,key = "RTF",None
+            elif entry[1].upper().startswith("PARA"):
+                block,key = "PARA","ATOM"
+            continue
+        if(word == "END"):
+            block,key = None,None
+            continue
+        if(block == "RTF"):
+            if(word == "RESI"):
+                key = entry[1]
+            elif(word == "PRES"):
+                key = None
+        elif(block == "PARA"):
+            if word[0:4] in charmm_prm_sections:
+                key = word[0:4]
+        yield (block,key,line)
+    f.close()
+#-----------------------------------------------------------------------
+def read_charmm_stream(filename,molname):
+    """
+    Returns (rtplines,prmlines): the lines of RESI molname (after the MASS
+    lines of the rtf blocks) and of the read para blocks of a CHARMM stream
+    file, read in a single pass
+    """
+    rtplines = []
+    masslines = []
+    prmlines = []
+    for block,key,line in iter_charmm_stream(filename):
+        if(block == "RTF" and key == molname):
+            rtplines.append(line)
+        elif(block == "RTF" and key is None and line.upper().startswith("MASS")):
+            masslines.append(line)
+        elif(block == "PARA"):
+            prmlines.append(line)
+    if(len(rtplines) > 0):
+        rtplines = masslines + rtplines
+    return rtplines,prmlines
+#-----------------------------------------------------------------------
+def get_charmm_rtp_lines(filename,molname):
+    rtplines=[]
+    for block,key,line in iter_charmm_stream(filename):
+        if(block == "RTF" and key == molname):
+            rtplines.append(line)
+    return rtplines
+#-----------------------------------------------------------------------
+def get_charmm_prm_lines(filename):
+    prmlines=[]
+    for block,key,line in iter_charmm_stream(filename):
+        if(block == "PARA"):
+            prmlines.append(line)
     return prmlines
 #-----------------------------------------------------------------------
+def get_mol2_columns(text,nlines,ncolumns):
+    """
+    Returns the first ncolumns columns of the lines of the body text of a
+    mol2 record, as lists of strings. text is split at once when it has
+    nlines lines of the same number of columns
+    """
+    words = text.split()
+    if(len(words) > 0):
+        nwords = len(text.lstrip().split("\n",1)[0].split())
+        if(nwords >= ncolumns and len(words) == nwords*nlines):
+            return [words[k::nwords] for k in range(ncolumns)]
+    table = [line.split() for line in text.splitlines() if line.strip()]
+    if(min([len(entry) for entry in table] or [ncolumns]) < ncolumns):
+        raise ValueError("missing columns")
+    return [[entry[k] for entry in table] for k in range(ncolumns)]
+#-----------------------------------------------------------------------
+def parse_numbers(words,dtype):
+    """
+    Returns the array of the numbers words, parsed by numpy in one call
+    """
+    values = np.fromstring(string.join(words," "),dtype=dtype,sep=" ")
+    if(len(values) != len(words)):
+        raise ValueError("bad number")
+    return values
+#-----------------------------------------------------------------------
+def parse_mol2_molecule(filename,lineno,record):
+    """
+    Returns (name, atom names, coordinates (n,3) float64, bonds (n,2) int32
+    from 0) of the text of a @<TRIPOS>MOLECULE record starting at the line
+    lineno, the atoms being ordered by their ids. Raises ValueError for bad
+    lines or counts.
+    """
+    sections = record.split("\n@<TRIPOS>")
+    head = sections[0].split("\n")
+    name = head[1].strip() if len(head) > 1 else ""
+    bodies = {"ATOM":"","BOND":""}
+    for section in sections[1:]:
+        title,sep,body = section.partition("\n")
+        bodies[title.strip()] = body
+    try:
+        counts = [int(n) for n in head[2].split()] if len(head) > 2 else []
+        counts = counts + [0]*(2-len(counts))
+        ids,names,x,y,z = get_mol2_columns(bodies["ATOM"],counts[0],5)
+        ids = parse_numbers(ids,np.int32)
+        coords = np.column_stack([parse_numbers(c,np.float64) for c in (x,y,z)]).reshape(len(ids),3)
+        bondid,ai,aj = get_mol2_columns(bodies["BOND"],counts[1],3)
+        bonds = np.column_stack((parse_numbers(ai,np.int32),parse_numbers(aj,np.int32))).reshape(len(ai),2) - 1
+    except (ValueError,IndexError):
+        raise ValueError("%s:%d: bad counts, ATOM or BOND line in molecule %s" % (filename,lineno,name))
+    if(counts[0] != len(ids) or counts[1] != len(bonds)):
+        raise ValueError("%s:%d: molecule %s has %d atoms and %d bonds, its header says %d %d" \
+                % (filename,lineno,name,len(ids),len(bonds),counts[0],counts[1]))
+    if not np.array_equal(np.sort(ids),np.arange(1,len(ids)+1)):
+        raise ValueError("%s:%d: the atom ids of molecule %s are not 1..%d" % (filename,lineno,name,len(ids)))
+    if(len(bonds) > 0 and (bonds.min() < 0 or bonds.max() >= len(ids))):
+        raise ValueError("%s:%d: bond to an unknown atom in molecule %s" % (filename,lineno,name))
+    order = np.argsort(ids)
+    return name,[names[i] for i in order.tolist()],coords[order],bonds
+#-----------------------------------------------------------------------
+def iter_mol2_molecules(filename,blocksize=1<<20):
+    """
+    Reads the @<TRIPOS>MOLECULE records of a (multi-molecule) mol2 file one
+    at a time and yields (name, atom names, coordinates, bonds) for each, see
+    parse_mol2_molecule(). The file is read by blocks of blocksize bytes cut
+    into records, the lines are not looped over; the records other than
+    MOLECULE, ATOM and BOND are skipped. A bad molecule raises ValueError
+    (the molecules before it have been yielded)
+    """
+    f = open(filename, 'r')
+    data = ""
+    while True:
+        block = f.read(blocksize)
+        data += block
+        start = data.find("@<TRIPOS>")
+        if(not block or (start >= 0 and len(data) >= start+len("@<TRIPOS>MOLECULE"))):
+            break
+    if(start < 0 and len(data.strip()) == 0):
+        f.close()
+        return
+    if(start < 0 or not data.startswith("@<TRIPOS>MOLECULE",start)):
+        f.close()
+        raise ValueError("%s: not a mol2 file, or records before @<TRIPOS>MOLECULE" % filename)
+    lineno = data.count("\n",0,start) + 1
+    data = data[start+len("@<TRIPOS>MOLECULE"):]
+    while True:
+        block = f.read(blocksize)
+        records = (data + block).split("@<TRIPOS>MOLECULE")
+        # the last record may go on in the next block
+        if block:
+            data = records.pop()
+        for record in records:
+            yield parse_mol2_molecule(filename,lineno,record)
+            lineno += record.count("\n")
+        if not block:
+            break
+    f.close()
+#-----------------------------------------------------------------------
 def parse_charmm_topology(rtplines):
 	topology = {}
-	noblanks = filter(lambda x: len(x.strip())>0, rtplines)
-	nocomments = filter(lambda x: x.strip()[0] not in ['*','!'], noblanks)
 	section = "BONDS"	# default
 	state = "free"
-	for line in nocomments:
+	for line in rtplines:
+		if len(line.strip()) == 0 or line.strip()[0] in ['*','!']:
+			continue
 		if state == "free":
 			if line.find("MASS") == 0:
 				if "ATOMS" not in topology.keys():
 					topology["ATOMS"] = {}
 				s = line.split()
 				idx,name,mass,type = int(s[1]),s[2],float(s[3]),s[4]
-				if line.find("!"):
+				if line.find("!") >= 0:
 					comment = line[line.find("!")+1:].strip()
 				else:
 					comment = ""
@@ -217,38 +940,33 @@ def parse_charmm_topology(rtplines):
 				group += 1
 				topology["RESI"][resname][group] = []
 			elif line.find("ATOM")==0: 
-				if line.find('!'):
-					line = line[:line.find('!')]
+				line = line.split('!')[0]
 				s = line.split()
 				name,type,charge = s[1],s[2],float(s[3])
 				topology["RESI"][resname][group].append((name,type,charge))
 			elif line.find("BOND")==0: 
-				if line.find('!'):
-					line = line[:line.find('!')]
+				line = line.split('!')[0]
 				s = line.split()
 				nbond = (len(s)-1)/2
 				for i in range(nbond):
 					p,q = s[1+2*i],s[2+2*i]
 					topology["RESI"][resname]["bonds"].append((p,q))
 			elif line.find("DOUB")==0: 
-				if line.find('!'):
-					line = line[:line.find('!')]
+				line = line.split('!')[0]
 				s = line.split()
 				ndouble = (len(s)-1)/2
 				for i in range(ndouble):
 					p,q = s[1+2*i],s[2+2*i]
 					topology["RESI"][resname]["double_bonds"].append((p,q))
 			elif line.find("IMPR")==0: 
-				if line.find('!'):
-					line = line[:line.find('!')]
+				line = line.split('!')[0]
 				s = line.split()
 				nimproper = (len(s)-1)/4
 				for i in range(nimproper):
 					impr = s[1+4*i],s[2+4*i],s[3+4*i],s[4+4*i]
 					topology["RESI"][resname]["impropers"].append(impr)
 			elif line.find("CMAP")==0: 
-				if line.find('!'):
-					line = line[:line.find('!')]
+				line = line.split('!')[0]
 				s = line.split()
 				#nimproper = (len(s)-1)/4
 				#for i in range(nimproper):
@@ -267,18 +985,16 @@ def parse_charmm_parameters(prmlines):
 
 	parameters = {}
 	cmapkey = ()
-	noblanks = filter(lambda x: len(x.strip())>0, prmlines)
-	nocomments = filter(lambda x: x.strip()[0] not in ['*','!'], noblanks)
 	section = "ATOM"	# default
-	for line in nocomments:
+	for line in prmlines:
+		if len(line.strip()) == 0 or line.strip()[0] in ['*','!']:
+			continue
                 #print line
-		sectionkeys = [ "BOND", "ANGL", "DIHE", \
-				"IMPR", "CMAP", "NONB", "HBON", "NBFI" ]
 		key = line.split()[0]
 
                 #exit()
 
-		if key[0:4] in sectionkeys:
+		if key[0:4] in charmm_prm_sections:
 			section = key[0:4]
 			continue
 
@@ -287,44 +1003,40 @@ def parse_charmm_parameters(prmlines):
 
                 #print line
 		if section == "BOND":
-			if line.find('!'):
-				line = line[:line.find('!')]
+			line = line.split('!')[0]
 			s = line.split()
 			ai, aj, kij, rij = s[0],s[1],float(s[2]),float(s[3])
 			parameters["BOND"].append((ai,aj,kij,rij))
 		elif section == "ANGL":
-			if line.find('!'):
-				line = line[:line.find('!')]
+			line = line.split('!')[0]
 			s = line.split()
 			ai, aj, ak = s[0],s[1],s[2]
 			other = map(float,s[3:])
 			parameters["ANGL"].append([ai,aj,ak]+other)
 		elif section == "DIHE":
-			if line.find('!'):
-				line = line[:line.find('!')]
+			line = line.split('!')[0]
 			s = line.split()
 			ai, aj, ak, al, k, n, d = s[0],s[1],s[2],s[3],float(s[4]),int(s[5]),float(s[6])
 			parameters["DIHE"].append([ai,aj,ak,al,k,n,d])
 		elif section == "IMPR":
-			if line.find('!'):
-				line = line[:line.find('!')]
+			line = line.split('!')[0]
 			s = line.split()
 			ai, aj, ak, al, k, d = s[0],s[1],s[2],s[3],float(s[4]),float(s[6])
 			parameters["IMPR"].append([ai,aj,ak,al,k,d])
 		elif section == "CMAP":
-			if line.find('!'):
-				line = line[:line.find('!')]
+			line = line.split('!')[0]
 			if cmapkey == ():
 				s = line.split()
 				a,b,c,d,e,f,g,h = s[0:8]
 				N = int(s[8])
 				cmapkey = (a,b,c,d,e,f,g,h,N)
-				cmaplist = []
+				cmapdata = []
 			else:
-				cmapdata = map(float,line.split())
-				cmaplist += cmapdata
-				if len(cmaplist) == N**2:
-					parameters["CMAP"].append([cmapkey,cmaplist])
+				cmapdata.extend(line.split())
+				if len(cmapdata) == N**2:
+					# the grid is converted once complete
+					grid = np.array(cmapdata,dtype=np.float64).reshape(N,N)
+					parameters["CMAP"].append([cmapkey,grid])
 					cmapkey = ()
 		elif section == "NONB":
 			if line.find("cutnb")>=0 or line.find("wmin")>=0 or line.find("CUTNB")>=0 or line.find("WMIN")>=0 :
@@ -347,116 +1059,491 @@ def parse_charmm_parameters(prmlines):
 				if "NONBONDED14" not in parameters.keys():
 					parameters["NONBONDED14"] = []
 				parameters["NONBONDED14"].append((atname,epsilon14,half_rmin14))
+		elif section == "NBFI":
+			line = line.split('!')[0]
+			s = line.split()
+			ai, aj, epsilon, rmin = s[0],s[1],-float(s[2]),float(s[3])
+			parameters["NBFI"].append((ai,aj,epsilon,rmin))
 
 
 	return parameters
 #-----------------------------------------------------------------------
-def write_gmx_bon(parameters,header_comments,filename):
-        kcal2kJ = 4.18400
-
-	outp = open(filename,"w")
-	outp.write("%s\n"%(header_comments))
-	outp.write("[ bondtypes ]\n")
-	kbond_conversion = 2.0*kcal2kJ/(0.1)**2   	# [kcal/mol]/A**2 -> [kJ/mol]/nm**2
-						# factor of 0.5 because charmm bonds are Eb(r)=Kb*(r-r0)**2
-	rbond_conversion = .1 			# A -> nm
-	outp.write(";%7s %8s %5s %12s %12s\n"%("i","j","func","b0","kb"))
-        if(parameters.has_key("BOND")):
-	    for p in parameters["BOND"]:
-		    ai,aj,kij,rij = p
-        	    rij *= rbond_conversion
-		    kij *= kbond_conversion
-		    outp.write("%8s %8s %5i %12.8f %12.2f\n"%(ai,aj,1,rij,kij))
-
-	kangle_conversion = 2.0*kcal2kJ		# [kcal/mol]/rad**2 -> [kJ/mol]/rad**2
-						# factor of 0.5 because charmm angles are Ea(r)=Ka*(a-a0)**2
-	kub_conversion = 2.0*kcal2kJ/(0.1)**2   	# [kcal/mol]/A**2 -> [kJ/mol]/nm**2prm
-	ub0_conversion = 0.1		   	# A -> nm
-
-	outp.write("\n\n[ angletypes ]\n")
-	outp.write(";%7s %8s %8s %5s %12s %12s %12s %12s\n"\
-			%("i","j","k","func","theta0","ktheta","ub0","kub"))
-        if(parameters.has_key("ANGL")):
-            for p in parameters["ANGL"]:
-		if len(p) == 5:
-		    ai,aj,ak,kijk,theta = p
-	            kub = 0.0
-		    ub0 = 0.0
-		else:
-		    ai,aj,ak,kijk,theta,kub,ub0 = p
-		
-		kijk *= kangle_conversion
-		kub *= kub_conversion
-		ub0 *= ub0_conversion
-		outp.write("%8s %8s %8s %5i %12.6f %12.6f %12.8f %12.2f\n"\
-				%(ai,aj,ak,5,theta,kijk,ub0,kub))
-
-	kdihe_conversion = kcal2kJ
-	outp.write("\n\n[ dihedraltypes ]\n")
-	outp.write(";%7s %8s %8s %8s %5s %12s %12s %5s\n"\
-			%("i","j","k","l","func","phi0","kphi","mult"))
-	#parameters["DIHEDRALS"].sort(demote_wildcards)
-        if(parameters.has_key("DIHE")):
-	    for p in parameters["DIHE"]:
-		ai,aj,ak,al,k,n,d = p
-		k *= kdihe_conversion
-		outp.write("%8s %8s %8s %8s %5i %12.6f %12.6f %5i\n"\
-				%(ai,aj,ak,al,9,d,k,n))
-
-	kimpr_conversion = kcal2kJ*2	# see above
-	outp.write("\n\n[ dihedraltypes ]\n")
-	outp.write("; 'improper' dihedrals \n")
-	outp.write(";%7s %8s %8s %8s %5s %12s %12s\n"\
-			%("i","j","k","l","func","phi0","kphi"))
-        if(parameters.has_key("IMPR")):
-	#parameters["IMPROPERS"].sort(demote_wildcards)
-    	    for p in parameters["IMPR"]:
-		ai,aj,ak,al,k,d = p
-		k *= kimpr_conversion
-		outp.write("%8s %8s %8s %8s %5i %12.6f %12.6f\n"\
-				%(ai,aj,ak,al,2,d,k))
-
-
-
-	outp.close()
-	return
-#-----------------------------------------------------------------------
-def write_gmx_mol_top(filename,ffdir,prmfile,itpfile,molname):
+def convert_charmm2gmx(parameters,section):
+    """
+    Converts the entries of a parameter section (BOND, ANGL, DIHE or IMPR, as
+    parsed by parse_charmm_parameters) to GROMACS units in one array operation
+
+    Returns (types,values): an (n,k) array of the atom types and an (n,m) float
+    array of the parameters in the column order of the GROMACS section
+    """
+    gmxsection,func,factors,order = charmm2gmx_units[section]
+    natoms = charmm_prm_natoms[section]
+    entries = parameters.get(section,[])
+    types = np.array([p[:natoms] for p in entries],dtype=object).reshape(len(entries),natoms)
+    values = np.zeros((len(entries),len(factors)))
+    for i,p in enumerate(entries):
+        values[i,:len(p)-natoms] = p[natoms:]   # missing Urey-Bradley terms stay 0
+    values *= factors
+    return types,values[:,order]
+#-----------------------------------------------------------------------
+def convert_cmap_charmm2gmx(parameters):
+    """
+    Converts the CMAP grids of parse_charmm_parameters() to GROMACS units in
+    one array operation
+
+    Returns (types,grids): an (n,5) array of the atom types (the two
+    dihedrals a-b-c-d and b-c-d-e) and an (n,N,N) float64 array in kJ/mol
+    """
+    entries = parameters.get("CMAP",[])
+    types = np.array([key[0:4]+key[7:8] for key,grid in entries],dtype=object).reshape(len(entries),5)
+    if(len(set([grid.shape for key,grid in entries])) > 1):
+        raise ValueError("CMAP grids of different sizes: grompp needs a single grid size")
+    grids = np.array([grid for key,grid in entries],dtype=np.float64)*kcal2kJ
+    return types,grids
+#-----------------------------------------------------------------------
+def get_gmx_cmaptypes(entries):
+    """
+    Returns the [ cmaptypes ] entries (tuples of strings, e.g. from
+    get_gmx_section(fftables,"cmaptypes")) as (types,grids), see
+    convert_cmap_charmm2gmx()
+    """
+    types = np.array([e[0:5] for e in entries],dtype=object).reshape(len(entries),5)
+    grids = np.array([e[8:] for e in entries],dtype=np.float64)
+    if(len(entries) > 0):
+        grids = grids.reshape(len(entries),int(entries[0][6]),int(entries[0][7]))
+    return types,grids
+#-----------------------------------------------------------------------
+def read_gmx_cmap(filename):
+    """
+    Reads the [ cmaptypes ] of a GROMACS file, e.g. cmap.itp, see get_gmx_cmaptypes()
+    """
+    return get_gmx_cmaptypes(read_gmx_sections(filename,{}).get("cmaptypes",[]))
+#-----------------------------------------------------------------------
+def render_gmx_cmap(types,grids):
+    """
+    Returns the [ cmaptypes ] entries of (types,grids) in the layout of
+    cmap.itp: 10 values per continued line, a blank line after each grid
+    """
+    out = []
+    for t,grid in zip(types.tolist(),grids):
+        values = grid.ravel().tolist()
+        nlines = (len(values)-1)//10
+        out.append("%s %s %s %s %s 1 %d %d\\\n" % (tuple(t)+grid.shape))
+        out.append(("%.8f "*9+"%.8f\\\n")*nlines % tuple(values[:nlines*10]))
+        out.append("%.8f "*(len(values)-nlines*10) % tuple(values[nlines*10:]) + "\n\n")
+    return string.join(out,"")
+#-----------------------------------------------------------------------
+def get_atomic_numbers(masses):
+    """
+    Returns the atomic numbers of the elements of the nearest mass,
+    0 when no element is within 0.5 (e.g. lone pairs)
+    """
+    table = np.array(element_masses)
+    masses = np.asarray(masses,dtype=float).reshape(-1)
+    nearest = np.abs(masses[:,np.newaxis]-table[:,0]).argmin(axis=1)
+    atnum = table[nearest,1].astype(int)
+    atnum[np.abs(masses-table[nearest,0]) > 0.5] = 0
+    return atnum
+#-----------------------------------------------------------------------
+def get_gmx_nonbonded(fftables):
+    """
+    Returns the non-bonded tables of the force field (see load_gmx_ffindex),
+    as needed by convert_nonbonded_charmm2gmx()
+    """
+    ffnonbonded = {}
+    for section in ["atomtypes","pairtypes","nonbond_params"]:
+        ffnonbonded[section] = get_gmx_section(fftables,section)
+    return ffnonbonded
+#-----------------------------------------------------------------------
+def convert_nonbonded_charmm2gmx(parameters,masses,ffnonbonded={}):
+    """
+    Converts the NONB, NONBONDED14 and NBFI parameters of parse_charmm_parameters()
+    to GROMACS sigma/epsilon, leaving out the types that are already in
+    ffnonbonded (see get_gmx_nonbonded()). masses: dict atom type -> mass
+
+    A new type gets 1-4 [ pairtypes ] (combination rule 2) with the types
+    that have their own 1-4 parameters, or with all the types if it has.
+
+    Returns a dict section -> (types,values), with the values
+      atomtypes:      (n,4) atnum, mass, sigma, epsilon
+      pairtypes:      (n,2) sigma, epsilon
+      nonbond_params: (n,2) sigma, epsilon
+    """
+    ffatomtypes = ffnonbonded.get("atomtypes",[])
+    known = set([e[0] for e in ffatomtypes])
+    types,values = convert_charmm2gmx(parameters,"NONB")
+    new = np.array([t not in known for t in types[:,0]],dtype=bool)
+    types,values = types[new],values[new]
+    mass = np.array([masses.get(t,0.0) for t in types[:,0]])
+    nonbonded = {"atomtypes": (types,np.column_stack([get_atomic_numbers(mass),mass,values]))}
+
+    # sigma/epsilon of all the types, and the 1-4 ones of the types that have them
+    lj = {}
+    for e in ffatomtypes:
+        lj[e[0]] = (float(e[-2]),float(e[-1]))
+    lj14 = {}
+    for e in ffnonbonded.get("pairtypes",[]):
+        if(e[0] == e[1]):
+            lj14[e[0]] = (float(e[3]),float(e[4]))
+    for t,v in zip(types[:,0].tolist(),values.tolist()):
+        lj[t] = tuple(v)
+    types14,values14 = convert_charmm2gmx(parameters,"NONBONDED14")
+    for t,v in zip(types14[:,0].tolist(),values14.tolist()):
+        if t in lj and t not in known:
+            lj14[t] = tuple(v)
+    known = set([get_type_key(e[:2]) for e in ffnonbonded.get("pairtypes",[])])
+    pairs = []
+    for t in types[:,0].tolist():
+        if t in lj14:
+            partners = sorted(lj.keys())
+        else:
+            partners = sorted(lj14.keys())
+        for u in partners:
+            key = get_type_key((t,u))
+            if key not in known:
+                known.add(key)
+                pairs.append(key)
+    a = np.array([lj14.get(i,lj[i]) for i,j in pairs]).reshape(-1,2)
+    b = np.array([lj14.get(j,lj[j]) for i,j in pairs]).reshape(-1,2)
+    nonbonded["pairtypes"] = (np.array(pairs,dtype=object).reshape(-1,2),
+            np.column_stack([0.5*(a[:,0]+b[:,0]),np.sqrt(a[:,1]*b[:,1])]))
+
+    known = set([get_type_key(e[:2]) for e in ffnonbonded.get("nonbond_params",[])])
+    types,values = convert_charmm2gmx(parameters,"NBFI")
+    new = np.array([get_type_key(t) not in known for t in types.tolist()],dtype=bool).reshape(-1)
+    nonbonded["nonbond_params"] = (types[new],values[new])
+    return nonbonded
+#-----------------------------------------------------------------------
+def render_gmx_nonbonded(nonbonded):
+    """
+    Returns the [ atomtypes ], [ pairtypes ] and [ nonbond_params ] of
+    convert_nonbonded_charmm2gmx() in the layout of ffnonbonded.itp and
+    nbfix.itp; the empty sections are left out
+    """
+    out = []
+    types,values = nonbonded["atomtypes"]
+    if(len(types) > 0):
+        out.append("[ atomtypes ]\n")
+        out.append(";type atnum         mass   charge ptype           sigma  epsilon\n")
+        out.append(format_table("%5s %5d %12.6f %8.3f  A  %.12f  %.5f\n",
+                [types[:,0],values[:,0].astype(int).tolist(),values[:,1].tolist(),[0.0]*len(types),
+                values[:,2].tolist(),values[:,3].tolist()]))
+        out.append("\n")
+    for section in ["pairtypes","nonbond_params"]:
+        types,values = nonbonded[section]
+        if(len(types) > 0):
+            out.append("[ %s ]\n" % (section))
+            out.append(format_table("%5s %5s  1  %.12f  %.12f\n",
+                    [types[:,0],types[:,1],values[:,0].tolist(),values[:,1].tolist()]))
+            out.append("\n")
+    return string.join(out,"")
+#-----------------------------------------------------------------------
+def convert_gmx2charmm(sections):
+    """
+    Converts GROMACS bonded types to CHARMM units, using the same conversion
+    tables as convert_charmm2gmx()
+    sections is a dict: section name -> entries (tuples of strings), e.g. from
+    read_gmx_sections(). Dihedral types of function 9 go to DIHE, of
+    function 2 to IMPR.
+
+    Returns a dict with the layout of parse_charmm_parameters()
+    """
+    parameters = {}
+    for section in charmm_bonded_sections:
+        gmxsection,func,factors,order = charmm2gmx_units[section]
+        natoms = charmm_prm_natoms[section]
+        entries = [e for e in sections.get(gmxsection,[]) if int(e[natoms]) == func]
+        if(len(entries) == 0):
+            continue
+        values = np.zeros((len(entries),len(factors)))
+        for i,e in enumerate(entries):
+            n = min(len(e)-natoms-1,len(factors))
+            values[i,order[:n]] = [float(x) for x in e[natoms+1:natoms+1+n]]
+        values /= factors
+        parameters[section] = []
+        for e,v in zip(entries,values.tolist()):
+            if(section == "DIHE"):
+                v[1] = int(round(v[1]))
+            parameters[section].append(list(e[:natoms])+v)
+    if "cmaptypes" in sections:
+        types,grids = get_gmx_cmaptypes(sections["cmaptypes"])
+        parameters["CMAP"] = []
+        for t,grid in zip(types.tolist(),grids/kcal2kJ):
+            parameters["CMAP"].append([tuple(t[0:4]+t[1:4]+t[4:5])+(len(grid),),grid])
+    return parameters
+#-----------------------------------------------------------------------
+def write_output(filename,text,compress=False):
+    """
+    Writes the rendered text of an output file with a single write.
+    With compress, the file is written gzip-compressed as filename.gz; this
+    is for archiving only, GROMACS does not read compressed topologies.
+
+    Returns the name of the file written
+    """
+    if(compress):
+        filename = filename + ".gz"
+        outp = gzip.open(filename,"wb")
+    else:
         outp = open(filename,"w")
-	outp.write("#include \"%s/forcefield.itp\"\n" % (ffdir))
-        outp.write("\n")
-        outp.write("; additional params for the molecule\n")
-	outp.write("#include \"%s\"\n" % (prmfile))
-        outp.write("\n")
-	outp.write("#include \"%s\"\n" % (itpfile))
-        outp.write("\n")
-	outp.write("#include \"%s/tip3p.itp\"\n" % (ffdir))
-        outp.write("#ifdef POSRES_WATER\n")
-        outp.write("; Position restraint for each water oxygen\n")
-        outp.write("[ position_restraints ]\n")
-        outp.write(";  i funct       fcx        fcy        fcz\n")
-        outp.write("   1    1       1000       1000       1000\n")
-        outp.write("#endif\n")
-        outp.write("\n")
-        outp.write("; Include topology for ions\n")
-	outp.write("#include \"%s/ions.itp\"\n" % (ffdir))
-        outp.write("\n")
-        outp.write("[ system ]\n")
-        outp.write("; Name\n")
-        outp.write("mol\n")
-        outp.write("\n")
-        outp.write("[ molecules ]\n")
-        outp.write("; Compound        #mols\n")
-	outp.write("%s          1\n" % (molname))
-        outp.write("\n")
-
-        outp.close()
+    outp.write(text)
+    outp.close()
+    return filename
+#-----------------------------------------------------------------------
+def format_table(fmt,columns):
+    """
+    Formats the rows whose values are given by columns (sequences of equal
+    length) with the row format fmt, in a single % operation
+    """
+    nrows = len(columns[0])
+    if(nrows == 0):
+        return ""
+    flat = [None]*(nrows*len(columns))
+    for i,column in enumerate(columns):
+        flat[i::len(columns)] = list(column)
+    return (fmt*nrows) % tuple(flat)
+#-----------------------------------------------------------------------
+def render_gmx_bon(parameters,header_comments,nonbonded=None):
+    """
+    Returns the text of the GROMACS parameter file of parameters, starting
+    with the non-bonded types of convert_nonbonded_charmm2gmx() if given
+    """
+    out = ["%s\n"%(header_comments)]
+    if(nonbonded is not None):
+        out.append(render_gmx_nonbonded(nonbonded))
+
+    out.append("[ bondtypes ]\n")
+    out.append(";%7s %8s %5s %12s %12s\n"%("i","j","func","b0","kb"))
+    types,values = convert_charmm2gmx(parameters,"BOND")
+    out.append(format_table("%8s %8s %5i %12.8f %12.2f\n",
+            [types[:,0],types[:,1],[1]*len(types),values[:,0].tolist(),values[:,1].tolist()]))
+
+    out.append("\n\n[ angletypes ]\n")
+    out.append(";%7s %8s %8s %5s %12s %12s %12s %12s\n"\
+            %("i","j","k","func","theta0","ktheta","ub0","kub"))
+    types,values = convert_charmm2gmx(parameters,"ANGL")
+    out.append(format_table("%8s %8s %8s %5i %12.6f %12.6f %12.8f %12.2f\n",
+            [types[:,0],types[:,1],types[:,2],[5]*len(types)]+values.T.tolist()))
+
+    out.append("\n\n[ dihedraltypes ]\n")
+    out.append(";%7s %8s %8s %8s %5s %12s %12s %5s\n"\
+            %("i","j","k","l","func","phi0","kphi","mult"))
+    types,values = convert_charmm2gmx(parameters,"DIHE")
+    out.append(format_table("%8s %8s %8s %8s %5i %12.6f %12.6f %5i\n",
+            [types[:,0],types[:,1],types[:,2],types[:,3],[9]*len(types),
+            values[:,0].tolist(),values[:,1].tolist(),values[:,2].astype(int).tolist()]))
+
+    out.append("\n\n[ dihedraltypes ]\n")
+    out.append("; 'improper' dihedrals \n")
+    out.append(";%7s %8s %8s %8s %5s %12s %12s\n"\
+            %("i","j","k","l","func","phi0","kphi"))
+    types,values = convert_charmm2gmx(parameters,"IMPR")
+    out.append(format_table("%8s %8s %8s %8s %5i %12.6f %12.6f\n",
+            [types[:,0],types[:,1],types[:,2],types[:,3],[2]*len(types),values[:,0].tolist(),values[:,1].tolist()]))
+
+    if(len(parameters.get("CMAP",[])) > 0):
+        out.append("\n\n[ cmaptypes ]\n\n")
+        out.append(render_gmx_cmap(*convert_cmap_charmm2gmx(parameters)))
+
+    return string.join(out,"")
+#-----------------------------------------------------------------------
+def write_charmm_prm(parameters,header_comments,filename,compress=False):
+    """
+    Writes parameters (layout of parse_charmm_parameters, e.g. converted back
+    by convert_gmx2charmm) as a CHARMM parameter file
+    """
+    out = ["* %s\n*\n\n" % (header_comments)]
+    out.append("BONDS\n")
+    entries = parameters.get("BOND",[])
+    out.append(format_table("%-8s %-8s %10.3f %10.4f\n",zip(*entries) or [[]]))
+    out.append("\nANGLES\n")
+    for p in parameters.get("ANGL",[]):
+        if(len(p) == 5 or p[5] == 0.0):
+            out.append("%-8s %-8s %-8s %10.3f %10.2f\n" % tuple(p[:5]))
+        else:
+            out.append("%-8s %-8s %-8s %10.3f %10.2f %10.3f %10.5f\n" % tuple(p))
+    out.append("\nDIHEDRALS\n")
+    entries = parameters.get("DIHE",[])
+    out.append(format_table("%-8s %-8s %-8s %-8s %10.4f %2i %8.2f\n",zip(*entries) or [[]]))
+    out.append("\nIMPROPERS\n")
+    entries = [p[:5]+[0]+p[5:] for p in parameters.get("IMPR",[])]
+    out.append(format_table("%-8s %-8s %-8s %-8s %10.4f %2i %8.2f\n",zip(*entries) or [[]]))
+    out.append("\nEND\n")
+    return write_output(filename,string.join(out,""),compress)
+#-----------------------------------------------------------------------
+def write_gmx_bon(parameters,header_comments,filename,compress=False,nonbonded=None):
+    return write_output(filename,render_gmx_bon(parameters,header_comments,nonbonded),compress)
+#-----------------------------------------------------------------------
+def render_gmx_mol_top(ffdir,prmfile,itpfile,molname):
+    """
+    Returns the text of the GROMACS topology of a single molecule
+    """
+    return string.join([
+        "#include \"%s/forcefield.itp\"\n" % (ffdir),
+        "\n",
+        "; additional params for the molecule\n",
+        "#include \"%s\"\n" % (prmfile),
+        "\n",
+        "#include \"%s\"\n" % (itpfile),
+        "\n",
+        "#include \"%s/tip3p.itp\"\n" % (ffdir),
+        "#ifdef POSRES_WATER\n",
+        "; Position restraint for each water oxygen\n",
+        "[ position_restraints ]\n",
+        ";  i funct       fcx        fcy        fcz\n",
+        "   1    1       1000       1000       1000\n",
+        "#endif\n",
+        "\n",
+        "; Include topology for ions\n",
+        "#include \"%s/ions.itp\"\n" % (ffdir),
+        "\n",
+        "[ system ]\n",
+        "; Name\n",
+        "mol\n",
+        "\n",
+        "[ molecules ]\n",
+        "; Compound        #mols\n",
+        "%s          1\n" % (molname),
+        "\n"],"")
+#-----------------------------------------------------------------------
+def write_gmx_mol_top(filename,ffdir,prmfile,itpfile,molname,compress=False):
+    return write_output(filename,render_gmx_mol_top(ffdir,prmfile,itpfile,molname),compress)
+#-----------------------------------------------------------------------
+def get_atom_indices(index,names):
+    """
+    Returns the indices of the atom names in index (a dict name -> index)
+    """
+    for name in names:
+        if name not in index:
+            raise ValueError("atomgroup:read_charmm_rtp> Atomname not found in top: %s" % name)
+    return [index[name] for name in names]
+#-----------------------------------------------------------------------
+def get_csr_adjacency(natoms,bonds):
+    """
+    Returns (ptr,idx), the int32 CSR adjacency of the (n,2) bond array: the
+    neighbors of atom i are idx[ptr[i]:ptr[i+1]], in increasing order
+    """
+    both = np.concatenate((bonds,bonds[:,::-1])).astype(np.int32)
+    both = both[np.lexsort((both[:,1],both[:,0]))]
+    ptr = np.zeros(natoms+1,dtype=np.int32)
+    ptr[1:] = np.cumsum(np.bincount(both[:,0],minlength=natoms))
+    return ptr,both[:,1].copy()
+#-----------------------------------------------------------------------
+def get_group_ranks(counts):
+    """
+    Returns for each element of groups of counts elements its rank in its
+    group: [0..counts[0]-1, 0..counts[1]-1, ...]
+    """
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts,counts)
+#-----------------------------------------------------------------------
+def get_csr_angles(ptr,idx):
+    """
+    Returns the (n,3) int32 angles (i,center,j) of the CSR adjacency: for each
+    center in increasing order, the pairs of its neighbors i before j
+    """
+    # for each neighbor slot, the slots after it with the same center
+    center = np.repeat(np.arange(len(ptr)-1,dtype=np.int32),np.diff(ptr))
+    slots = np.arange(len(idx))
+    counts = ptr[center+1] - 1 - slots
+    first = np.repeat(slots,counts)
+    second = first + 1 + get_group_ranks(counts)
+    angles = np.column_stack((idx[first],center[first],idx[second]))
+    return angles.astype(np.int32).reshape(-1,3)
+#-----------------------------------------------------------------------
+def get_csr_dihedrals(ptr,idx,bonds):
+    """
+    Returns the (n,4) int32 proper dihedrals (k,i,j,l) of the CSR adjacency:
+    for each bond (i,j) in order, the neighbors k of i (but j) and l of j
+    (but i) in order, with k != l (3-membered rings)
+    """
+    bonds = np.asarray(bonds,dtype=np.int32).reshape(-1,2)
+    degi = ptr[bonds[:,0]+1] - ptr[bonds[:,0]]
+    degj = ptr[bonds[:,1]+1] - ptr[bonds[:,1]]
+    counts = degi*degj
+    bond = np.repeat(np.arange(len(bonds)),counts)
+    rank = get_group_ranks(counts)
+    k = idx[ptr[bonds[bond,0]] + rank // degj[bond]]
+    l = idx[ptr[bonds[bond,1]] + rank % degj[bond]]
+    i = bonds[bond,0]
+    j = bonds[bond,1]
+    keep = (k != j) & (l != i) & (k != l)
+    return np.column_stack((k[keep],i[keep],j[keep],l[keep])).astype(np.int32).reshape(-1,4)
+#-----------------------------------------------------------------------
+def get_pair_keys(natoms,pairs):
+    """
+    Returns the sorted unique int64 keys i*natoms+j (i<j) of the (n,2) pairs
+    """
+    pairs = np.sort(np.asarray(pairs,dtype=np.int64).reshape(-1,2),axis=1)
+    return np.unique(pairs[:,0]*natoms + pairs[:,1])
+#-----------------------------------------------------------------------
+def get_neighbor_pairs(natoms,bonds):
+    """
+    Returns [pairs12,pairs13,pairs14]: the (n,2) int32 pairs (i,j), i<j,
+    sorted, of the atoms 1, 2 and 3 bonds apart (shortest path). The
+    candidates are the ends of the paths of 1, 2 and 3 bonds of the CSR
+    adjacency (get_csr_angles(), get_csr_dihedrals()), so that the atoms of
+    a ring closer by the other way are not 1-3 or 1-4 pairs
+    """
+    bonds = np.asarray(bonds,dtype=np.int32).reshape(-1,2)
+    ptr,idx = get_csr_adjacency(natoms,bonds)
+    keys12 = get_pair_keys(natoms,bonds)
+    keys13 = get_pair_keys(natoms,get_csr_angles(ptr,idx)[:,::2])
+    keys13 = keys13[~np.in1d(keys13,keys12)]
+    keys14 = get_pair_keys(natoms,get_csr_dihedrals(ptr,idx,bonds)[:,::3])
+    keys14 = keys14[~(np.in1d(keys14,keys12) | np.in1d(keys14,keys13))]
+    return [np.column_stack((keys // natoms,keys % natoms)).astype(np.int32).reshape(-1,2)
+            for keys in (keys12,keys13,keys14)]
+#-----------------------------------------------------------------------
+def get_exclusions(natoms,bonds,nrexcl=3):
+    """
+    Returns the sorted (n,2) pairs (i,j), i<j, of the atoms at most nrexcl
+    bonds apart (1 to 3), excluded from the non-bonded interactions
+    """
+    pairs = get_neighbor_pairs(natoms,bonds)[:nrexcl]
+    pairs = np.concatenate(pairs + [np.zeros((0,2),dtype=np.int32)])
+    return pairs[np.lexsort((pairs[:,1],pairs[:,0]))]
+#-----------------------------------------------------------------------
+def render_gmx_pairs(pairs):
+    """
+    Returns the [ pairs ] section of the (n,2) atom indices (from 0)
+    """
+    out = ["[ pairs ]\n",";  ai    aj funct            c0            c1            c2            c3\n"]
+    out.append(format_table("%5d %5d     1\n",(np.asarray(pairs)+1).T.tolist()))
+    out.append("\n")
+    return string.join(out,"")
+#-----------------------------------------------------------------------
+def render_gmx_exclusions(pairs):
+    """
+    Returns the [ exclusions ] section of the sorted (n,2) pairs (i,j), i<j,
+    of get_exclusions(): one line per atom i with all its atoms j
+    """
+    out = ["[ exclusions ]\n",";  ai    aj ...\n"]
+    pairs = np.asarray(pairs).reshape(-1,2) + 1
+    starts = np.nonzero(np.diff(pairs[:,0]))[0] + 1
+    for group in np.split(pairs,starts):
+        if(len(group) > 0):
+            out.append("%5d %s\n" % (group[0,0],string.join(["%5d" % j for j in group[:,1].tolist()]," ")))
+    out.append("\n")
+    return string.join(out,"")
 #=================================================================================================================
+# per-atom fields of atomgroup.atoms (coordinates are in atomgroup.coord)
+atomgroup_dtype = [ ('name','S8'), ('type','S8'), ('resname','S8'), ('segid','S8'), ('resid','i4'),
+        ('charge','f8'), ('mass','f8'), ('beta','f8') ]
+
 class atomgroup:
     """
     A class that contains the data structures and functions to store and process
     data related to groups of atoms (read molecules)
 
+    The data is kept in numpy arrays:
+      atoms      (natoms,) structured array of atomgroup_dtype
+      coord      (natoms,3) float array
+      bonds      (nbonds,2) int32 array, i<j, sorted
+      bond_ptr, bond_idx  int32 CSR adjacency of the bonds (see neighbors())
+      angles     (nangles,3), dihedrals (ndihedrals,4), impropers (nimpropers,4) int32 arrays
+      cmaps      (ncmaps,5) int32 array, the CMAP dihedral pairs a-b-c-d, b-c-d-e
+    Atom indices start at 0.
+
     USAGE: m = atomgroup()
     """
 
@@ -465,46 +1552,83 @@ class atomgroup:
 
     def __init__(self):
         self.molcount = self.molcount+1 #TODO
-        self.G = nx.Graph()
         self.name = ""
-        self.natoms = 0
-        self.nbonds = 0
-        self.angles = []
+        self.set_atoms(np.zeros(0,dtype=atomgroup_dtype),np.zeros((0,2),dtype=np.int32),
+                np.zeros((0,4),dtype=np.int32))
+
+    #-----------------------------------------------------------------------
+    def set_atoms(self,atoms,bonds,impropers):
+        """
+        Sets the atoms, bonds and impropers; angles and dihedrals are reset
+        """
+        self.atoms = atoms
+        self.natoms = len(atoms)
+        self.coord = np.zeros((self.natoms,3),dtype=float)
+        bonds = np.sort(np.asarray(bonds,dtype=np.int32).reshape(-1,2),axis=1)
+        if(len(bonds) > 0):
+            # the same bond may be given twice (BOND and DOUB)
+            bonds = np.unique(bonds[:,0].astype(np.int64)*max(self.natoms,1)+bonds[:,1])
+            bonds = np.array([bonds//max(self.natoms,1),bonds%max(self.natoms,1)],dtype=np.int32).T
+        self.bonds = bonds
+        self.nbonds = len(bonds)
+        self.bond_ptr,self.bond_idx = get_csr_adjacency(self.natoms,self.bonds)
+        self.impropers = np.asarray(impropers,dtype=np.int32).reshape(-1,4)
+        self.nimpropers = len(self.impropers)
+        self.cmaps = np.zeros((0,5),dtype=np.int32)
+        self.ncmaps = 0
+        self.angles = np.zeros((0,3),dtype=np.int32)
         self.nangles = 0
-        self.dihedrals = []
+        self.dihedrals = np.zeros((0,4),dtype=np.int32)
         self.ndihedrals = 0
-        self.impropers = []
-        self.nimpropers = 0
-        #self.coord=np.zeros((self.natoms,3),dtype=float)
-
+    #-----------------------------------------------------------------------
+    def neighbors(self,atomi):
+        return self.bond_idx[self.bond_ptr[atomi]:self.bond_ptr[atomi+1]]
+    #-----------------------------------------------------------------------
+    def to_networkx(self):
+        """
+        Returns the molecule as a networkx graph with the node/edge attributes
+        of the former atomgroup.G, for code that works on graphs
+        """
+        import networkx as nx
+        G = nx.Graph()
+        for atomi in range(0,self.natoms):
+            atom = self.atoms[atomi]
+            G.add_node(atomi, {'type':atom['type'], 'resname':atom['resname'], 'name':atom['name'],
+                'charge':float(atom['charge']), 'mass':float(atom['mass']), 'beta':float(atom['beta']),
+                'x':float(self.coord[atomi][0]), 'y':float(self.coord[atomi][1]), 'z':float(self.coord[atomi][2]),
+                'segid':atom['segid'], 'resid':str(atom['resid']) })
+        for i,j in self.bonds:
+            G.add_edge(int(i),int(j),order='1')
+        return G
     #-----------------------------------------------------------------------
     def read_charmm_rtp(self,rtplines,atomtypes):
         """
         Reads CHARMM rtp
-        Reads atoms, bonds, impropers
-        Stores connectivity as a graph
+        Reads atoms, bonds, impropers, cmaps
+        The masses of the atom types are taken from atomtypes, or from MASS lines
+        Stores connectivity as a CSR adjacency
         Autogenerates angles and dihedrals
 
         USAGE: m = atomgroup() ; m.read_charmm_rtp(rtplines,atomtypes)
 
         """
         #initialize everything
-        self.G = nx.Graph()
         self.name = ""
-        self.natoms = 0
-        self.nbonds = 0
-        self.angles = []
-        self.nangles = 0
-        self.dihedrals = []
-        self.ndihedrals = 0
-        self.impropers = []
-        self.nimpropers = 0
-
-        atm = {}
+        atm = []
+        bonds = []
+        impropers = []
+        cmaps = []
+        index = {}  # atom name -> atom index
+        masses = {} # atom type -> mass
+        for typei in atomtypes:
+            masses.setdefault(typei[0],float(typei[1]))
 
         for line in rtplines:
-	    if line.find('!'):
-	        line = line[:line.find('!')]
+            line = line.split('!')[0]
+
+            if line.startswith("MASS"):
+                entry = line.split()
+                masses.setdefault(entry[2],float(entry[3]))
 
             if line.startswith("RESI"):
                 entry = re.split('\s+', string.lstrip(line))
@@ -512,296 +1636,646 @@ class atomgroup:
 
             if line.startswith("ATOM"):
                 entry = re.split('\s+', string.lstrip(line))
-                atm[self.natoms] = {'type':entry[2], 'resname':self.name, 'name':entry[1],
-                      'charge':float(entry[3]),'mass':float(0.00), 'beta':float(0.0),
-                        'x':float(9999.9999),'y':float(9999.9999),'z':float(9999.9999),'segid':self.name, 'resid':'1' }
-
-                for typei in atomtypes:
-                    if(typei[0] == atm[self.natoms]['type']):
-                        atm[self.natoms]['mass'] = float(typei[1])
-                        break
-
-                self.G.add_node(self.natoms, atm[self.natoms])
-                self.natoms=self.natoms+1
+                index.setdefault(entry[1],len(atm))
+                atm.append((entry[1],entry[2],self.name,self.name,1,
+                        float(entry[3]),masses.get(entry[2],float(0.00)),float(0.0)))
 
             if line.startswith("BOND") or line.startswith("DOUB"):
-                entry = re.split('\s+', string.rstrip(string.lstrip(line)))
+                entry = line.split()
                 numbonds = int((len(entry)-1)/2)
                 for bondi in range(0,numbonds):
-                    found1 = False
-                    found2 = False
-                    for i in range(0,self.natoms):
-                        if(atm[i]['name'] == entry[(bondi*2)+1]):
-                            found1 = True
-                            break
-                    for j in range(0,self.natoms):
-                        if(atm[j]['name'] == entry[(bondi*2)+2]):
-                            found2 = True
-                            break
-                    if(not found1):
-                        print "Error:atomgroup:read_charmm_rtp> Atomname not found in top",entry[(bondi*2)+1]
-                    if(not found2):
-                        print "Error:atomgroup:read_charmm_rtp> Atomname not found in top",entry[(bondi*2)+2]
-                    self.G.add_edge(i,j)
-                    self.G[i][j]['order']='1' # treat all bonds as single for now
-                    self.nbonds=self.nbonds+1
+                    bonds.append(get_atom_indices(index,entry[(bondi*2)+1:(bondi*2)+3]))
 
             if line.startswith("IMP"):
-                entry = re.split('\s+', string.lstrip(line))
-                numimpr = int((len(entry)-2)/4)
+                entry = line.split()
+                numimpr = int((len(entry)-1)/4)
                 for impi in range(0,numimpr):
-                    for i in range(0,self.natoms):
-                        if(atm[i]['name'] == entry[(impi*4)+1]):
-                            break
-                    for j in range(0,self.natoms):
-                        if(atm[j]['name'] == entry[(impi*4)+2]):
-                            break
-                    for k in range(0,self.natoms):
-                        if(atm[k]['name'] == entry[(impi*4)+3]):
-                            break
-                    for l in range(0,self.natoms):
-                        if(atm[l]['name'] == entry[(impi*4)+4]):
-                            break
-                    var = [i,j,k,l]
-                    self.impropers.append(var)
+                    impropers.append(get_atom_indices(index,entry[(impi*4)+1:(impi*4)+5]))
 
-        self.nimpropers = len(self.impropers)
-        if(self.ndihedrals > 0 or self.nangles > 0):
-            print "WARNING:atomgroup:read_charmm_rtp> Autogenerating angl-dihe even though they are preexisting",self.nangles,self.ndihedrals
+            if line.startswith("CMAP"):
+                entry = line.split()
+                cmaps.append(get_atom_indices(index,entry[1:5]+entry[8:9]))
+
+        self.set_atoms(np.array(atm,dtype=atomgroup_dtype),bonds,impropers)
+        self.cmaps = np.array(cmaps,dtype=np.int32).reshape(-1,5)
+        self.ncmaps = len(self.cmaps)
         self.autogen_angl_dihe()
-        self.coord = np.zeros((self.natoms,3),dtype=float)
 #-----------------------------------------------------------------------
     def autogen_angl_dihe(self):
-        self.angles = []
-        for atomi in range(0,self.natoms):
-            nblist = []
-            for nb in self.G.neighbors(atomi):
-                nblist.append(nb)
-            for i in range(0,len(nblist)-1):
-                for j in range(i+1,len(nblist)):
-                    var = [nblist[i],atomi,nblist[j]]
-                    self.angles.append(var)
+        """
+        Sets the angles and proper dihedrals of the bonds, enumerated from the
+        CSR adjacency (see get_csr_angles() and get_csr_dihedrals())
+        """
+        self.angles = get_csr_angles(self.bond_ptr,self.bond_idx)
         self.nangles = len(self.angles)
-        self.dihedrals = []
-        for i,j in self.G.edges_iter():
-            nblist1 = []
-            for nb in self.G.neighbors(i):
-                if(nb != j):
-                    nblist1.append(nb)
-            nblist2 = []
-            for nb in self.G.neighbors(j):
-                if(nb != i):
-                    nblist2.append(nb)
-            if(len(nblist1) > 0 and len(nblist2) > 0 ):
-                for ii in range(0,len(nblist1)):
-                    for jj in range(0,len(nblist2)):
-                        var = [nblist1[ii],i,j,nblist2[jj]]
-                        if(var[0] != var[3]):
-                            self.dihedrals.append(var)
+        self.dihedrals = get_csr_dihedrals(self.bond_ptr,self.bond_idx,self.bonds)
         self.ndihedrals = len(self.dihedrals)
 #-----------------------------------------------------------------------
-    def get_nonplanar_dihedrals(self,angl_params):
+    def get_nonplanar_dihedrals(self,linear):
+        """
+        Returns the dihedrals that do not contain a linear angle, linear being
+        the set of get_linear_angltypes(), e.g. across a triple bond
+        """
+        types = self.atoms['type']
         nonplanar_dihedrals=[]
-        cutoff=179.9
         for var in self.dihedrals:
-            d1=self.G.node[var[0]]['type']            
-            d2=self.G.node[var[1]]['type']
-            d3=self.G.node[var[2]]['type']
-            d4=self.G.node[var[3]]['type']
-            keep=1
-            for angl_param in angl_params:
-                p1=angl_param[0]
-                p2=angl_param[1]
-                p3=angl_param[2]
-                eq=angl_param[3]
-                if( d2==p2 and ( ( d1==p1 and d3==p3) or (d1==p3 and d3==p1))):
-                    if(eq > cutoff):
-                        keep=-1
-                        break
-                if( d3==p2 and ( (d2==p1 and d4==p3) or (d2==p3 and d4==p1))):
-                    if(eq > cutoff):
-                        keep=-1
-                        break
-
-                 
-            if(keep==1):
-                nonplanar_dihedrals.append(var)
+            d1,d2,d3,d4 = types[var]
+            if((d1,d2,d3) in linear or (d2,d3,d4) in linear):
+                continue
+            nonplanar_dihedrals.append(var)
 
         return nonplanar_dihedrals
 #-----------------------------------------------------------------------
-    def write_gmx_itp(self,filename,angl_params):
-        f = open(filename, 'w')
-        f.write("; Created by cgenff_charmm2gmx.py\n")
-        f.write("\n")
-        f.write("[ moleculetype ]\n")
-        f.write("; Name            nrexcl\n")
-        f.write("%s              3\n" % self.name)
-        f.write("\n")
-        f.write("[ atoms ]\n")
-        f.write(";   nr       type  resnr residue  atom   cgnr     charge       mass  typeB    chargeB      massB\n")
-        f.write("; residue   1 %s rtp %s q  qsum\n" % (self.name,self.name))
-        pairs14 = nx.Graph()
-        for atomi in range(0,self.natoms):
-            pairs14.add_node(atomi)
-            f.write("%6d %10s %6s %6s %6s %6d %10.3f %10.3f   ;\n" % 
-               ( atomi+1,self.G.node[atomi]['type'],
-               self.G.node[atomi]['resid'],self.name,self.G.node[atomi]['name'],atomi+1,
-               self.G.node[atomi]['charge'],self.G.node[atomi]['mass'] ) )
-        f.write("\n")
-        f.write("[ bonds ]\n")
-        f.write(";  ai    aj funct            c0            c1            c2            c3\n")
-        for i,j in self.G.edges_iter():
-            f.write("%5d %5d     1\n" % (i+1,j+1) )
-        f.write("\n")
-        f.write("[ pairs ]\n")
-        f.write(";  ai    aj funct            c0            c1            c2            c3\n")
-        for var in self.dihedrals:
-            if (len(nx.dijkstra_path(self.G,var[0],var[3])) == 4): #this is to remove 1-2 and 1-3 included in dihedrals of rings
-                pairs14.add_edge(var[0],var[3])
-        for i,j in pairs14.edges_iter():
-            f.write("%5d %5d     1\n" % (i+1,j+1) )
-        f.write("\n")
-        f.write("[ angles ]\n")
-        f.write(";  ai    aj    ak funct            c0            c1            c2            c3\n")
-        for var in self.angles:
-            f.write("%5d %5d %5d    5\n" % (var[0]+1,var[1]+1,var[2]+1) )
-        f.write("\n")
-        f.write("[ dihedrals ]\n")
-        f.write(";  ai    aj    ak    al funct            c0            c1            c2            c3            c4            c5\n")
-        nonplanar_dihedrals=self.get_nonplanar_dihedrals(angl_params)
-        for var in nonplanar_dihedrals:
-            f.write("%5d %5d %5d %5d     9\n" % (var[0]+1,var[1]+1,var[2]+1,var[3]+1) )
-        f.write("\n")
+    def get_pairs14(self):
+        """
+        Returns the sorted list of 1-4 pairs (i,j), i<j: atoms exactly 3 bonds
+        apart. 1-2 and 1-3 atoms closed by a ring are not 1-4 pairs.
+        """
+        return [tuple(pair) for pair in get_neighbor_pairs(self.natoms,self.bonds)[2].tolist()]
+#-----------------------------------------------------------------------
+    def render_gmx_itp(self,linear):
+        """
+        Returns the text of the GROMACS itp of the molecule, linear being the
+        linear angle types (see get_nonplanar_dihedrals())
+        """
+        natoms = np.arange(1,self.natoms+1)
+        out = []
+        out.append("; Created by cgenff_charmm2gmx.py\n")
+        out.append("\n")
+        out.append("[ moleculetype ]\n")
+        out.append("; Name            nrexcl\n")
+        out.append("%s              3\n" % self.name)
+        out.append("\n")
+        out.append("[ atoms ]\n")
+        out.append(";   nr       type  resnr residue  atom   cgnr     charge       mass  typeB    chargeB      massB\n")
+        out.append("; residue   1 %s rtp %s q  qsum\n" % (self.name,self.name))
+        out.append(format_table("%6d %10s %6d %6s %6s %6d %10.3f %10.3f   ;\n",
+                [natoms.tolist(),self.atoms['type'].tolist(),self.atoms['resid'].tolist(),[self.name]*self.natoms,
+                self.atoms['name'].tolist(),natoms.tolist(),self.atoms['charge'].tolist(),self.atoms['mass'].tolist()]))
+        out.append("\n")
+        out.append("[ bonds ]\n")
+        out.append(";  ai    aj funct            c0            c1            c2            c3\n")
+        out.append(format_table("%5d %5d     1\n",(self.bonds+1).T.tolist()))
+        out.append("\n")
+        out.append("[ pairs ]\n")
+        out.append(";  ai    aj funct            c0            c1            c2            c3\n")
+        pairs14 = np.array(self.get_pairs14(),dtype=np.int32).reshape(-1,2)
+        out.append(format_table("%5d %5d     1\n",(pairs14+1).T.tolist()))
+        out.append("\n")
+        out.append("[ angles ]\n")
+        out.append(";  ai    aj    ak funct            c0            c1            c2            c3\n")
+        out.append(format_table("%5d %5d %5d    5\n",(self.angles+1).T.tolist()))
+        out.append("\n")
+        out.append("[ dihedrals ]\n")
+        out.append(";  ai    aj    ak    al funct            c0            c1            c2            c3            c4            c5\n")
+        nonplanar_dihedrals = np.array(self.get_nonplanar_dihedrals(linear),dtype=np.int32).reshape(-1,4)
+        out.append(format_table("%5d %5d %5d %5d     9\n",(nonplanar_dihedrals+1).T.tolist()))
+        out.append("\n")
         if(self.nimpropers > 0):
-            f.write("[ dihedrals ]\n")
-            f.write(";  ai    aj    ak    al funct            c0            c1            c2            c3\n")
-            for var in self.impropers:
-                f.write("%5d %5d %5d %5d     2\n" % (var[0]+1,var[1]+1,var[2]+1,var[3]+1) )
-            f.write("\n")
-        f.close()
+            out.append("[ dihedrals ]\n")
+            out.append(";  ai    aj    ak    al funct            c0            c1            c2            c3\n")
+            out.append(format_table("%5d %5d %5d %5d     2\n",(self.impropers+1).T.tolist()))
+            out.append("\n")
+        if(self.ncmaps > 0):
+            out.append("[ cmap ]\n")
+            out.append(";  ai    aj    ak    al    am funct\n")
+            out.append(format_table("%5d %5d %5d %5d %5d     1\n",(self.cmaps+1).T.tolist()))
+            out.append("\n")
+        return string.join(out,"")
+#-----------------------------------------------------------------------
+    def write_gmx_itp(self,filename,linear,compress=False):
+        return write_output(filename,self.render_gmx_itp(linear),compress)
 
 #-----------------------------------------------------------------------
     def read_mol2_coor_only(self,filename):
-        check_natoms = 0
-        check_nbonds = 0
-        f = open(filename, 'r')
-        atm = {}
-        section="NONE"
-        for line in f.readlines():
-            secflag=False
-            if line.startswith("@"):
-                secflag=True
-                section="NONE"
-
-
-            if((section=="NATO") and (not secflag)):
-                entry = re.split('\s+', string.lstrip(line))
-                check_natoms=int(entry[0])
-                check_nbonds=int(entry[1])
-                if(check_natoms != self.natoms):
-                    print "error in atomgroup.py: read_mol2_coor_only: natoms in mol2 .ne. top"
-                    print check_natoms,self.natoms
-                    exit()
-                if(check_nbonds != self.nbonds):
-                    print "error in atomgroup.py: read_mol2_coor_only: nbonds in mol2 .ne. top"
-                    print check_nbonds,self.nbonds
-                    exit()
-
-                section="NONE"  
-
-            if((section=="MOLE") and (not secflag)):
-                self.name=line.strip()
-                section="NATO" #next line after @<TRIPOS>MOLECULE contains atom, bond numbers
-
-            if((section=="ATOM") and (not secflag)):
-                entry = re.split('\s+', string.lstrip(line))
-                atomi = int(entry[0])-1
-                self.G.node[atomi]['x'] = float(entry[2])
-                self.G.node[atomi]['y'] = float(entry[3])
-                self.G.node[atomi]['z'] = float(entry[4])
-                self.coord[atomi][0] = float(entry[2])
-                self.coord[atomi][1] = float(entry[3])
-                self.coord[atomi][2] = float(entry[4])
-
-            if line.startswith("@<TRIPOS>MOLECULE"):
-                section="MOLE"
-            if line.startswith("@<TRIPOS>ATOM"):
-                section="ATOM"
-            if line.startswith("@<TRIPOS>BOND"):
-                section="BOND"
+        """
+        Sets the name and the coordinates of the molecule from the first
+        molecule of the mol2 file filename (see iter_mol2_molecules()).
+        Raises ValueError if its numbers of atoms or bonds differ
+        """
+        for name,names,coord,bonds in iter_mol2_molecules(filename):
+            break
+        else:
+            raise ValueError("%s: no @<TRIPOS>MOLECULE" % filename)
+        if(len(coord) != self.natoms or len(bonds) != self.nbonds):
+            raise ValueError("%s: %d atoms and %d bonds in %s, %d atoms and %d bonds in the topology" \
+                    % (filename,len(coord),len(bonds),name,self.natoms,self.nbonds))
+        self.name = name
+        self.coord[:] = coord
+#-----------------------------------------------------------------------
+    def render_pdb(self):
+        """
+        Returns the PDB text (ATOM records) of the molecule. Raises
+        ValueError if an atom name is longer than 4 characters
+        """
+        names = self.atoms['name'].tolist()
+        for name in names:
+            if(len(name) > 4):
+                raise ValueError("atom name %s of %s longer than 4 characters" % (name,self.name))
+        # 4-letter names start one column earlier
+        names = [name+" " if len(name) == 4 else " %-4.4s" % name for name in names]
+        text = format_table("ATOM  %5d %5s%-4.4s %4d    %8.3f%8.3f%8.3f%6.2f%6.2f\n",
+                [range(1,self.natoms+1),names,[self.name]*self.natoms,self.atoms['resid'].tolist(),
+                self.coord[:,0].tolist(),self.coord[:,1].tolist(),self.coord[:,2].tolist(),
+                [1.0]*self.natoms,self.atoms['beta'].tolist()])
+        return text + "END\n"
 #-----------------------------------------------------------------------
     def write_pdb(self,f):
-        for atomi in range(0,self.natoms):
-            if(len(self.G.node[atomi]['name']) > 4):
-                print "error in atomgroup.write_pdb(): atom name >  characters"
-                exit()
-
-            if(len(self.G.node[atomi]['name']) == 4):
-                f.write("ATOM  %5d %-4.4s %-4.4s %4s    %8.3f%8.3f%8.3f%6.2f%6.2f\n" %
-                (atomi+1,self.G.node[atomi]['name'],self.name,self.G.node[atomi]['resid'],self.coord[atomi][0],
-                self.coord[atomi][1],self.coord[atomi][2],1.0,self.G.node[atomi]['beta']))
-            else:
-                f.write("ATOM  %5d  %-4.4s%-4.4s %4s    %8.3f%8.3f%8.3f%6.2f%6.2f\n" %
-                (atomi+1,self.G.node[atomi]['name'],self.name,self.G.node[atomi]['resid'],self.coord[atomi][0],
-                self.coord[atomi][1],self.coord[atomi][2],1.0,self.G.node[atomi]['beta']))
-        f.write("END\n")
+        f.write(self.render_pdb())
 
 #=================================================================================================================
+# GROMACS bonded type sections: number of atoms of a type, whether X wildcards apply
+gmx_bonded_sections = { "bondtypes":(2,False), "angletypes":(3,False), "dihedraltypes":(4,True) }
 
+def get_gmx_bonded_sections(parameters):
+    """
+    Returns the CHARMM parameters of parse_charmm_parameters() as GROMACS
+    bonded type sections, in the layout of read_gmx_sections()
+    """
+    sections = {}
+    for section in charmm_bonded_sections:
+        gmxsection,func,factors,order = charmm2gmx_units[section]
+        types,values = convert_charmm2gmx(parameters,section)
+        rows = sections.setdefault(gmxsection,[])
+        for t,v in zip(types.tolist(),values.tolist()):
+            rows.append(tuple(t)+(func,)+tuple(v))
+    return sections
+#-----------------------------------------------------------------------
+def remove_duplicate_parameters(parameters,duplicates,conflicts=False):
+    """
+    Returns a copy of the CHARMM parameters without the types that are
+    duplicates (see bondedparams.find_duplicates()); conflicts are kept
+    unless conflicts is set
+    """
+    removed = set()
+    for section,funct,key,status in duplicates:
+        if(status == "duplicate" or conflicts):
+            removed.add((section,funct,key))
+    parameters = dict(parameters)
+    for section in charmm_bonded_sections:
+        gmxsection,func,factors,order = charmm2gmx_units[section]
+        natoms = charmm_prm_natoms[section]
+        parameters[section] = [p for p in parameters.get(section,[])
+                if (gmxsection,func,get_type_key(p[:natoms])) not in removed]
+    return parameters
+#-----------------------------------------------------------------------
+def print_duplicate_parameters(duplicates,prmfile):
+    nduplicates = len([d for d in duplicates if d[3] == "duplicate"])
+    if(nduplicates > 0):
+        print "NOTE: %d parameters of %s are already in the force field (see NOTE3)" % (nduplicates,prmfile)
+    for section,funct,key,status in duplicates:
+        if(status == "conflict"):
+            print "WARNING: [ %s ] %s in %s differs from the force field" % (section,string.join(key," "),prmfile)
+    return
+#-----------------------------------------------------------------------
+def get_wildcard_tiers(natoms):
+    """
+    Returns the masks (True: the type is replaced by X) of natoms types,
+    grouped by number of wildcards: [[no X], [one X, ...], ...]
+    """
+    tiers = [[] for i in range(natoms+1)]
+    for bits in range(2**natoms):
+        mask = [bool(bits>>i & 1) for i in range(natoms)]
+        tiers[sum(mask)].append(mask)
+    return tiers
 
-if(len(sys.argv) != 5):
-    print "Usage: RESNAME drug.mol2 drug.str charmm36.ff"
-    exit()
-
-mol_name = sys.argv[1]
-mol2_name = sys.argv[2]
-rtp_name = sys.argv[3]
-ffdir = sys.argv[4]
-atomtypes_filename = ffdir + "/atomtypes.atp"
-
-print "NOTE1: Code tested with python 2.7.3. Your version:",sys.version
-print ""
-print "NOTE2: Please be sure to use the same version of CGenFF in your simulations that was used during parameter generation:"
-check_versions(rtp_name,ffdir + "/forcefield.doc")
-print ""
-print "NOTE3: In order to avoid duplicated parameters, do NOT select the 'Include parameters that are already in CGenFF' option when uploading a molecule into CGenFF."
-
-
-#for output
-itpfile = mol_name.lower() + ".itp"
-prmfile = mol_name.lower() + ".prm"
-initpdbfile = mol_name.lower() + "_ini.pdb"
-topfile = mol_name.lower() +".top"
+wildcard_tiers = get_wildcard_tiers(4)
+#-----------------------------------------------------------------------
+def get_type_key(types):
+    # a type tuple and its reverse are the same parameter
+    types = tuple(types)
+    return min(types,types[::-1])
+#-----------------------------------------------------------------------
+class bondedparams:
+    """
+    Hash indexes of the GROMACS bonded types ([ bondtypes ], [ angletypes ],
+    [ dihedraltypes ]) for assigning parameters to interactions, as grompp does
+
+    Each index is keyed by (section, funct) then by the canonical type tuple
+    (see get_type_key), so a lookup costs a fixed number of dict accesses.
+    The tables are added in layers, e.g. the force field then the parameters
+    of the molecule; a type defined again in a later layer replaces it.
+    Dihedrals fall back on the X wildcard types: the match with the fewest
+    wildcards is used, and several matches with as many wildcards are
+    ambiguous (grompp silently takes the first one).
+
+    USAGE: ffparams = bondedparams() ; ffparams.add_fftables(fftables)
+           p = bondedparams(ffparams.layers) ; p.add_charmm_parameters(params)
+           status,matches = p.lookup("dihedraltypes",9,("CG2R61","CG2R61","CG301","SG311"))
+    """
+    def __init__(self,layers=[]):
+        self.layers = list(layers)  # [ {(section,funct): {key: (order,rows)}} ]
 
-atomtypes = read_gmx_atomtypes(atomtypes_filename)
+    #-----------------------------------------------------------------------
+    def add_sections(self,sections):
+        """
+        Adds a layer from the [ section ] tables of read_gmx_sections()
+        """
+        layer = {}
+        order = 0
+        for section,(natoms,wildcards) in gmx_bonded_sections.items():
+            for entry in sections.get(section,[]):
+                index = layer.setdefault((section,int(entry[natoms])),{})
+                key = get_type_key(entry[:natoms])
+                if key not in index:
+                    index[key] = (order,[])
+                    order = order+1
+                # several entries: multiple dihedral terms
+                index[key][1].append(tuple([float(x) for x in entry[natoms+1:]]))
+        self.layers.append(layer)
+    #-----------------------------------------------------------------------
+    def add_fftables(self,fftables):
+        """
+        Adds a layer from the tables of load_gmx_ffindex()
+        """
+        sections = {}
+        for section in gmx_bonded_sections:
+            sections[section] = get_gmx_section(fftables,section)
+        self.add_sections(sections)
+    #-----------------------------------------------------------------------
+    def add_charmm_parameters(self,parameters):
+        """
+        Adds a layer from the CHARMM parameters of parse_charmm_parameters()
+        """
+        self.add_sections(get_gmx_bonded_sections(parameters))
+    #-----------------------------------------------------------------------
+    def find_duplicates(self,sections):
+        """
+        Compares the bonded types of sections (as read by read_gmx_sections(),
+        e.g. of a generated .prm) with the types already indexed: a type is
+        a "duplicate" when all its values are the same (within the precision
+        of the files), a "conflict" otherwise. Types are matched by hash key,
+        no wildcards.
 
-angl_params = []  #needed for detecting triple bonds
-filelist = get_filelist_from_gmx_forcefielditp(ffdir,"forcefield.itp")
-for filename in filelist:
-    anglpars = read_gmx_anglpars(filename)
-    angl_params = angl_params + anglpars
+        Returns a list of (section, funct, key, status)
+        """
+        duplicates = []
+        for section,(natoms,wildcards) in gmx_bonded_sections.items():
+            rows = {}
+            keys = []
+            for entry in sections.get(section,[]):
+                key = (int(entry[natoms]),get_type_key(entry[:natoms]))
+                if key not in rows:
+                    rows[key] = []
+                    keys.append(key)
+                rows[key].append(tuple([float(x) for x in entry[natoms+1:]]))
+            for funct,key in keys:
+                indexes = [layer[(section,funct)] for layer in self.layers if (section,funct) in layer]
+                for index in reversed(indexes):
+                    if key in index:
+                        a = sorted(rows[(funct,key)])
+                        b = sorted(index[key][1])
+                        if(len(a) == len(b) and np.allclose(a,b,rtol=1e-5,atol=1e-6)):
+                            duplicates.append((section,funct,key,"duplicate"))
+                        else:
+                            duplicates.append((section,funct,key,"conflict"))
+                        break
+        return duplicates
+    #-----------------------------------------------------------------------
+    def lookup(self,section,funct,types):
+        """
+        Finds the parameters of an interaction between atoms of the given types
 
+        Returns (status,matches): status is "ok", "unmatched" or "ambiguous";
+        matches are the (key,rows) found, the one grompp uses first
+        """
+        natoms,wildcards = gmx_bonded_sections[section]
+        indexes = [layer[(section,funct)] for layer in self.layers if (section,funct) in layer]
+        if(wildcards):
+            tiers = wildcard_tiers
+        else:
+            tiers = wildcard_tiers[:1]
+        for tier in tiers:
+            keys = set()
+            for mask in tier:
+                keys.add(get_type_key([("X" if x else t) for x,t in zip(mask,types)]))
+            matches = []
+            for key in keys:
+                for i in range(len(indexes)-1,-1,-1):
+                    if key in indexes[i]:
+                        matches.append(((i,indexes[i][key][0]),key,indexes[i][key][1]))
+                        break
+            if(len(matches) > 0):
+                matches.sort()
+                status = "ok"
+                if(len(matches) > 1):
+                    status = "ambiguous"
+                return status,[(key,rows) for order,key,rows in matches]
+        return "unmatched",[]
+#-----------------------------------------------------------------------
+def check_bonded_parameters(m,params,linear):
+    """
+    Looks up the parameters of every interaction written by write_gmx_itp()
+    for the atomgroup m in params (a bondedparams), linear being the linear
+    angle types
 
-m = atomgroup()
-rtplines=get_charmm_rtp_lines(rtp_name,mol_name)
-m.read_charmm_rtp(rtplines,atomtypes)
+    Returns the problems: a list of (section, funct, atom indices, status, matches)
+    """
+    types = m.atoms['type']
+    interactions = [("bondtypes",1,m.bonds), ("angletypes",5,m.angles),
+            ("dihedraltypes",9,m.get_nonplanar_dihedrals(linear)),
+            ("dihedraltypes",2,m.impropers)]
+    problems = []
+    found = {}  # many interactions share the same types
+    for section,funct,atoms in interactions:
+        for var in atoms:
+            t = tuple(types[var])
+            if((section,funct,t) not in found):
+                found[(section,funct,t)] = params.lookup(section,funct,t)
+            status,matches = found[(section,funct,t)]
+            if(status != "ok"):
+                problems.append((section,funct,tuple(var),status,matches))
+    return problems
+#-----------------------------------------------------------------------
+def print_bonded_problems(m,problems):
+    for section,funct,var,status,matches in problems:
+        kind = {1:"bond",5:"angle",9:"dihedral",2:"improper"}[funct]
+        atoms = "%s (%s)" % (string.join(m.atoms['name'][list(var)],"-"),string.join(m.atoms['type'][list(var)]," "))
+        if(status == "unmatched"):
+            print "WARNING: no [ %s ] parameters for %s %s" % (section,kind,atoms)
+        else:
+            print "WARNING: ambiguous [ %s ] parameters for %s %s: %s (grompp uses the first)" \
+                    % (section,kind,atoms,string.join([string.join(key," ") for key,rows in matches],", "))
+    return
+#=================================================================================================================
+def get_charmm_resnames(filename):
+    resnames = []
+    f = open(filename, 'r')
+    for line in f:
+        if line.startswith("RESI"):
+            resnames.append(line.split()[1])
+    f.close()
+    return resnames
+#-----------------------------------------------------------------------
+class gmxforcefield:
+    """
+    The tables of the force field ffdir used by the conversions, loaded once:
+    atomtypes (read_gmx_atomtypes), linear_angltypes (get_linear_angltypes),
+    params (bondedparams) and nonbonded (get_gmx_nonbonded)
+    """
+    def __init__(self,ffdir):
+        self.ffdir = ffdir
+        self.atomtypes = read_gmx_atomtypes(os.path.join(ffdir,"atomtypes.atp"))
+        fftables = load_gmx_ffindex(ffdir,"forcefield.itp")
+        # needed for detecting triple bonds
+        self.linear_angltypes = get_linear_angltypes(get_gmx_anglpars(fftables),linear_angle_cutoff)
+        self.params = bondedparams()
+        self.params.add_fftables(fftables)
+        self.nonbonded = get_gmx_nonbonded(fftables)
+#-----------------------------------------------------------------------
+forcefields = {}    # ffdir -> gmxforcefield, see load_forcefield()
 
+def load_forcefield(ffdir):
+    """
+    Returns the gmxforcefield of ffdir, loaded by the first call only
+    """
+    if ffdir not in forcefields:
+        forcefields[ffdir] = gmxforcefield(ffdir)
+    return forcefields[ffdir]
+#-----------------------------------------------------------------------
+class cgenffmolecule:
+    """
+    A molecule converted by convert(): the texts of the output files (see
+    OUTPUT above) are kept in memory, write() writes them.
+      name       RESNAME
+      molecule   the atomgroup
+      itp, prm, top, pdb  texts of drug.itp, drug.prm, drug.top, drug_ini.pdb
+      duplicates the parameters already in the force field (find_duplicates())
+      problems   the interactions without unique parameters (check_bonded_parameters())
+    """
+    def __init__(self,name,molecule):
+        self.name = name
+        self.molecule = molecule
+        self.itp = self.prm = self.top = self.pdb = ""
+        self.duplicates = []
+        self.problems = []
+        self.filenames = { "itp":name.lower() + ".itp", "prm":name.lower() + ".prm",
+                "top":name.lower() + ".top", "pdb":name.lower() + "_ini.pdb" }
+#-----------------------------------------------------------------------
+    def write(self,outdir=".",compress=False):
+        """
+        Writes the output files in outdir, gzipped with compress; returns
+        their names
+        """
+        return [write_output(os.path.join(outdir,self.filenames[key]),getattr(self,key),compress)
+                for key in ("pdb","prm","itp","top")]
+#-----------------------------------------------------------------------
+def convert(mol_name,mol2_name,rtp_name,ff,dedup=False):
+    """
+    Converts the molecule mol_name of the stream file rtp_name, with the
+    coordinates of mol2_name, for the force field ff (a directory or a
+    gmxforcefield): the outputs are kept in memory, see cgenffmolecule.
+    The only side effects are those of load_forcefield() when ff is a
+    directory loaded for the first time: its compiled index is updated
+    under FFINDEX_DIR, with a WARNING printed if it cannot be written.
+    The parameters of the molecule already in the force field are left out
+    of the .prm with dedup. The non-bonded types of the molecule are written
+    unless they are in the force field.
+
+    USAGE: c = convert("ZZD","zzd.mol2","zzd.str","charmm36.ff")
+           c.itp, c.problems
+           c.write("zzd")
+
+    Returns the cgenffmolecule
+    """
+    if not isinstance(ff,gmxforcefield):
+        ff = load_forcefield(ff)
+    m = atomgroup()
+    rtplines,prmlines = read_charmm_stream(rtp_name,mol_name)
+    if(len(rtplines) == 0):
+        raise ValueError("RESI %s not found in %s" % (mol_name,rtp_name))
+    m.read_charmm_rtp(rtplines,ff.atomtypes)
+    c = cgenffmolecule(mol_name,m)
+
+    m.read_mol2_coor_only(mol2_name)
+    c.pdb = m.render_pdb()
+
+    params = parse_charmm_parameters(prmlines)
+    c.duplicates = ff.params.find_duplicates(get_gmx_bonded_sections(params))
+    if(dedup):
+        params = remove_duplicate_parameters(params,c.duplicates)
+    masses = dict([(t[0],float(t[1])) for t in ff.atomtypes])
+    masses.update(zip(m.atoms['type'].tolist(),m.atoms['mass'].tolist()))
+    nonbonded = convert_nonbonded_charmm2gmx(params,masses,ff.nonbonded)
+    c.prm = render_gmx_bon(params,"",nonbonded)
+    types,values = convert_charmm2gmx(params,"ANGL")
+    anglpars = [[ai,aj,ak,theta0] for (ai,aj,ak),theta0 in zip(types.tolist(),values[:,0].tolist())]
+    linear = ff.linear_angltypes | get_linear_angltypes(anglpars,linear_angle_cutoff) # add the new angl params
+
+    c.itp = m.render_gmx_itp(linear)
+    c.top = render_gmx_mol_top(ff.ffdir,c.filenames["prm"],c.filenames["itp"],mol_name)
+
+    molparams = bondedparams(ff.params.layers)
+    molparams.add_charmm_parameters(params)
+    c.problems = check_bonded_parameters(m,molparams,linear)
+    return c
+#-----------------------------------------------------------------------
+def convert_molecule(mol_name,mol2_name,rtp_name,ff,outdir=".",compress=False,dedup=False):
+    """
+    Converts the molecule mol_name of the stream file rtp_name with
+    convert(), writes the output files in outdir (gzipped with compress) and
+    prints the duplicated parameters and the interactions without unique
+    parameters
 
-m.read_mol2_coor_only(mol2_name)
-f = open(initpdbfile, 'w')
-m.write_pdb(f)
-f.close()
+    Returns the cgenffmolecule
+    """
+    c = convert(mol_name,mol2_name,rtp_name,ff,dedup)
+    print_duplicate_parameters(c.duplicates,c.filenames["prm"])
+    c.write(outdir,compress)
+    print_bonded_problems(c.molecule,c.problems)
+    return c
+#-----------------------------------------------------------------------
+def get_batch_jobs(path):
+    """
+    Returns the jobs (name, resname, mol2, str, outdir) of a batch, path being:
+     - a manifest with one job per line: RESNAME drug.mol2 drug.str [outdir]
+       (paths relative to the manifest, blank lines and '#' comments skipped)
+     - or a directory of ParamChem outputs drug.str/drug.mol2; the resname is
+       the first RESI entry of drug.str
+    The job name is the basename of the stream file; by default the outputs
+    of a job are written in ./name, in the current directory
+
+    Raises ValueError if two jobs have the same name or outdir: they would
+    overwrite each other's outputs and summary lines
+    """
+    jobs = []
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith(".str"):
+                continue
+            name = filename[:-4]
+            rtp_name = os.path.join(path,filename)
+            resnames = get_charmm_resnames(rtp_name)
+            resname = resnames[0] if resnames else ""
+            jobs.append((name,resname,os.path.join(path,name+".mol2"),rtp_name,name))
+        return jobs
+
+    jobs = read_batch_manifest(path)
+    for i,what in [(0,"name"),(4,"outdir")]:
+        seen = {}
+        for job in jobs:
+            key = job[i]
+            if(i == 4):
+                key = os.path.normpath(os.path.abspath(key))
+            if key in seen:
+                raise ValueError("%s: the jobs of %s and %s have the same %s %s" % (path,seen[key],job[3],what,job[i]))
+            seen[key] = job[3]
+    return jobs
+#-----------------------------------------------------------------------
+def read_batch_manifest(path):
+    """
+    Returns the jobs of the manifest path, see get_batch_jobs()
+    """
+    jobs = []
+    topdir = os.path.dirname(path)
+    f = open(path, 'r')
+    for line in f:
+        entry = line.split("#")[0].split()
+        if(len(entry) == 0):
+            continue
+        if(len(entry) not in (3,4)):
+            raise ValueError("%s: expected RESNAME drug.mol2 drug.str [outdir]: %s" % (path,line.strip()))
+        mol2_name = os.path.join(topdir,entry[1])
+        rtp_name = os.path.join(topdir,entry[2])
+        name = os.path.splitext(os.path.basename(rtp_name))[0]
+        if(len(entry) == 4):
+            outdir = os.path.join(topdir,entry[3])
+        else:
+            outdir = name
+        jobs.append((name,entry[0],mol2_name,rtp_name,outdir))
+    f.close()
+    return jobs
+#-----------------------------------------------------------------------
+batch_ff = {}   # force field and options shared by the batch workers
 
+def init_batch_worker(ff,compress=False,dedup=False):
+    batch_ff["ff"] = ff
+    batch_ff["dedup"] = dedup
+    batch_ff["compress"] = compress
+#-----------------------------------------------------------------------
+def run_batch_job(job):
+    """
+    Runs one job of get_batch_jobs(); returns (name, status, message) and
+    never raises, so that one bad ligand does not stop the batch
+    """
+    name,mol_name,mol2_name,rtp_name,outdir = job
+    try:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        c = convert_molecule(mol_name,mol2_name,rtp_name,batch_ff["ff"],outdir,batch_ff["compress"],batch_ff["dedup"])
+        if(len(c.problems) > 0):
+            return (name,"WARNING","%s: %d atoms, written in %s, %d interactions without unique parameters"
+                    % (mol_name,c.molecule.natoms,outdir,len(c.problems)))
+        return (name,"OK","%s: %d atoms, written in %s" % (mol_name,c.molecule.natoms,outdir))
+    except Exception, e:
+        return (name,"FAILED","%s: %s" % (e.__class__.__name__,e))
+#-----------------------------------------------------------------------
+def run_batch(path,ffdir,nproc,summaryfile,compress=False,dedup=False):
+    """
+    Converts all the jobs of path (see get_batch_jobs) with nproc processes.
+    The force field is loaded once; a line per job is written in summaryfile
 
-prmlines=get_charmm_prm_lines(rtp_name)
-params = parse_charmm_parameters(prmlines)
-write_gmx_bon(params,"",prmfile)
-anglpars = read_gmx_anglpars(prmfile)
-angl_params = angl_params + anglpars # append the new angl params
+    Returns the number of failed jobs
+    """
+    jobs = get_batch_jobs(path)
+    ff = load_forcefield(ffdir)
+    if(nproc > 1):
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc,init_batch_worker,(ff,compress,dedup))
+        results = pool.map(run_batch_job,jobs,chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        init_batch_worker(ff,compress,dedup)
+        results = map(run_batch_job,jobs)
+
+    nfailed = 0
+    f = open(summaryfile, 'w')
+    f.write("; %-28s %-7s %s\n" % ("job","status","message"))
+    for name,status,message in results:
+        if(status == "FAILED"):
+            nfailed = nfailed+1
+        f.write("%-30s %-7s %s\n" % (name,status,message))
+    f.close()
+    print "Batch: %d jobs, %d converted, %d failed, see %s" % (len(jobs),len(jobs)-nfailed,nfailed,summaryfile)
+    return nfailed
 
+#=================================================================================================================
 
-m.write_gmx_itp(itpfile,angl_params)
-write_gmx_mol_top(topfile,ffdir,prmfile,itpfile,mol_name)
 
-exit()
+if __name__ == "__main__":
+    compress = "--gzip" in sys.argv
+    dedup = "--dedup" in sys.argv
+    for option in ("--gzip","--dedup"):
+        if option in sys.argv:
+            sys.argv.remove(option)
+
+    if(len(sys.argv) in (4,5) and sys.argv[1] == "--batch"):
+        if(len(sys.argv) == 5):
+            nproc = int(sys.argv[4])
+        else:
+            import multiprocessing
+            nproc = multiprocessing.cpu_count()
+        run_batch(sys.argv[2],sys.argv[3],nproc,"batch_summary.txt",compress,dedup)
+        exit()
+
+    if(len(sys.argv) != 5):
+        print "Usage: [--gzip] [--dedup] RESNAME drug.mol2 drug.str charmm36.ff"
+        print "       [--gzip] [--dedup] --batch jobs.txt|jobdir charmm36.ff [nproc]"
+        exit()
+
+    mol_name = sys.argv[1]
+    mol2_name = sys.argv[2]
+    rtp_name = sys.argv[3]
+    ffdir = sys.argv[4]
+
+    print "NOTE1: Code tested with python 2.7.3. Your version:",sys.version
+    print ""
+    print "NOTE2: Please be sure to use the same version of CGenFF in your simulations that was used during parameter generation:"
+    check_versions(rtp_name,ffdir + "/forcefield.doc")
+    print ""
+    print "NOTE3: In order to avoid duplicated parameters, do NOT select the 'Include parameters that are already in CGenFF' option when uploading a molecule into CGenFF."
+
+    convert_molecule(mol_name,mol2_name,rtp_name,load_forcefield(ffdir),".",compress,dedup)
 
+    exit()
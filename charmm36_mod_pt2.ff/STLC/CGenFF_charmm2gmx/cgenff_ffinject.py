@@ -0,0 +1,373 @@
+# USAGE: ./cgenff_ffinject.py [--nohdb] DRUG drug.str charmm36.ff newff.ff
+#        ./cgenff_ffinject.py [--nohdb] --batch jobs.txt|jobdir charmm36.ff newff.ff
+# Tested with Python 2.7. Requires cgenff_charmm2gmx.py (numpy)
+
+# Adds the molecule DRUG of the CHARMM stream file drug.str as a residue of a copy of the
+# force field charmm36.ff, so that pdb2gmx can handle it like the STLC residue ZZD (see
+# ../../notes.txt). newff.ff is copied from charmm36.ff if it does not exist yet, then:
+#   (1) merged.rtp    - gets the [ DRUG ] residue: atoms, bonds, impropers
+#   (2) merged.hdb    - gets the DRUG hydrogen entries, guessed from the bonds. A molecule whose
+#                       hydrogens cannot all be described (e.g. H17 and H18 on one atom: they must
+#                       be named H1, H2, ...) is not added, unless --nohdb is given: then DRUG has
+#                       no .hdb entry and pdb2gmx must be run without -ignh
+#   (3) ffbonded.itp  - gets the bonded types of drug.str that are not in the force field yet
+#   (4) atomtypes.atp - gets the atom types of DRUG that are not in the force field yet
+# A residue that is already in newff.ff is replaced: run it again after changing drug.str.
+# The files are indexed by byte offset (sidecar files merged.rtp.idx, ..., see load_residue_index()
+# in cgenff_charmm2gmx.py) and the bonded types of the force field are read from its compiled index
+# (load_gmx_ffindex()): a new residue is appended to each file and an existing one is spliced in
+# place, the other blocks are neither parsed nor reformatted, and the indexes are updated.
+# The blocks added to ffbonded.itp and atomtypes.atp are between "; BEGIN DRUG" and "; END DRUG"
+# comments, when DRUG has new types. The non-bonded parameters of new atom types are not added,
+# and DRUG must still be added to residuetypes.dat.
+# In batch mode, the jobs are given as for cgenff_charmm2gmx.py --batch (the mol2 files are not used).
+
+import string
+import re
+import sys
+import os
+import shutil
+import time
+from cgenff_charmm2gmx import atomgroup, bondedparams, read_charmm_stream, parse_charmm_parameters, \
+        parse_gmx_sections, get_gmx_bonded_sections, remove_duplicate_parameters, render_gmx_bon, format_table, \
+        get_batch_jobs, get_rtp_blocks, get_hdb_blocks, charmm_bonded_sections, load_residue_index, \
+        save_residue_index, load_gmx_ffindex, get_gmx_section, update_gmx_ffindex
+
+# block added by this script to ffbonded.itp or atomtypes.atp
+marked_block_re = re.compile(r"^; BEGIN (\S+)\n.*?^; END \1\n", re.M|re.S)
+# atom type line of an .atp file
+atp_line_re = re.compile(r"^[ \t]*([^;\s]\S*)[^\n]*\n?", re.M)
+
+# pdb2gmx hydrogen type from (number of hydrogens, number of neighbors) of a heavy atom:
+# 1 planar H, 2 single H (e.g. hydroxyl), 3 two planar H, 4 tetrahedral H (methyl),
+# 5 one tetrahedral H, 6 two tetrahedral H
+hdb_types = { (1,2):2, (1,3):1, (1,4):5, (2,3):3, (2,4):6, (3,4):4 }
+# number of atoms placing the hydrogens, after the heavy atom, for each type
+hdb_nrefs = { 1:2, 2:2, 3:2, 4:2, 5:3, 6:2 }
+
+#-----------------------------------------------------------------------
+def get_marked_blocks(data):
+    """
+    Returns the blocks added by this script to a force-field file: a dict
+    "; BEGIN name" -> (start,end) byte offsets
+    """
+    blocks = {}
+    for m in marked_block_re.finditer(data):
+        blocks["; BEGIN " + m.group(1)] = (m.start(),m.end())
+    return blocks
+#-----------------------------------------------------------------------
+def get_atp_blocks(data):
+    """
+    Returns the index of the text of an .atp file: the byte offsets of the
+    line of every atom type and of the blocks added by this script (see
+    get_marked_blocks)
+    """
+    blocks = get_marked_blocks(data)
+    for m in atp_line_re.finditer(data):
+        blocks.setdefault(m.group(1),(m.start(),m.end()))
+    return blocks
+#-----------------------------------------------------------------------
+def read_atomtypes(filename,blocks,types,skip=(0,0)):
+    """
+    Returns the entries [type,mass] of the .atp file filename for types,
+    read through its index blocks (see get_atp_blocks), except those in
+    the byte range skip
+    """
+    atomtypes = []
+    f = open(filename, 'r')
+    for atomtype in types:
+        if atomtype in blocks and not (skip[0] <= blocks[atomtype][0] < skip[1]):
+            start,end = blocks[atomtype]
+            f.seek(start)
+            atomtypes.append(f.read(end-start).split()[:2])
+    f.close()
+    return atomtypes
+#-----------------------------------------------------------------------
+def read_block(filename,blocks,name):
+    """
+    Returns the text of the block name of filename, "" if it is not in the
+    index blocks
+    """
+    if name not in blocks:
+        return ""
+    start,end = blocks[name]
+    f = open(filename, 'r')
+    f.seek(start)
+    text = f.read(end-start)
+    f.close()
+    return text
+#-----------------------------------------------------------------------
+def splice_block(filename,blocks,get_blocks,name,text):
+    """
+    Writes text as the block name of filename, blocks being its index (see
+    load_residue_index) and get_blocks the function building it: a new
+    block is appended, an existing one is replaced and only the rest of the
+    file after it is written again. The index is updated and saved
+
+    Returns the new index
+    """
+    f = open(filename, 'r+b')
+    f.seek(0,2)
+    size = f.tell()
+    if name in blocks:
+        start,end = blocks[name]
+    else:
+        start = end = size
+        if(size > 0):
+            f.seek(size-1)
+            if(f.read(1) != "\n"):
+                text = "\n" + text
+    f.seek(end)
+    tail = f.read()
+    f.seek(start)
+    f.write(text)
+    f.write(tail)
+    f.truncate()
+    f.close()
+
+    # the blocks after the spliced one are shifted, those in it replaced
+    shift = len(text) - (end-start)
+    newblocks = {}
+    for key,(s,e) in blocks.items():
+        if(e <= start):
+            newblocks[key] = (s,e)
+        elif(s >= end):
+            newblocks[key] = (s+shift,e+shift)
+    for key,(s,e) in get_blocks(text).items():
+        newblocks[key] = (start+s,start+e)
+    save_residue_index(filename,newblocks,get_blocks)
+    return newblocks
+#-----------------------------------------------------------------------
+def render_rtp_residue(m):
+    """
+    Returns the .rtp residue block of the atomgroup m
+    """
+    names = m.atoms['name']
+    out = ["[ %s ]\n" % (m.name)]
+    out.append("  [ atoms ]\n")
+    out.append(format_table("\t%5s %6s %8.3f %2d\n",
+            [names.tolist(),m.atoms['type'].tolist(),m.atoms['charge'].tolist(),range(1,m.natoms+1)]))
+    out.append("  [ bonds ]\n")
+    out.append(format_table("\t%5s %5s\n",names[m.bonds].T.tolist()))
+    if(m.nimpropers > 0):
+        out.append("  [ impropers ]\n")
+        out.append(format_table("\t%5s %5s %5s %5s\n",names[m.impropers].T.tolist()))
+    out.append("\n")
+    return string.join(out,"")
+#-----------------------------------------------------------------------
+def render_hdb_entry(m):
+    """
+    Returns the .hdb entry of the atomgroup m: for each heavy atom with
+    hydrogens, the pdb2gmx hydrogen type (see hdb_types) and the atoms
+    that place them. Several hydrogens of an atom must be named base1,
+    base2, ... (the hdb gives base only)
+
+    Raises ValueError if the hydrogens of some atoms cannot be described:
+    a partial entry would make pdb2gmx fail on the missing hydrogens
+    """
+    names = m.atoms['name']
+    mass = m.atoms['mass']
+    hydrogen = (mass > 0.5) & (mass < 1.5)
+    lines = []
+    skipped = []
+    for atomi in range(m.natoms):
+        if hydrogen[atomi]:
+            continue
+        neighbors = m.neighbors(atomi)
+        hs = [j for j in neighbors if hydrogen[j]]
+        heavy = [j for j in neighbors if not hydrogen[j]]
+        if(len(hs) == 0):
+            continue
+        htype = hdb_types.get((len(hs),len(neighbors)))
+        if(htype in (1,5,6)):
+            refs = heavy
+        elif(htype is not None and len(heavy) == 1):
+            # the heavy neighbor and one of its other neighbors
+            others = [k for k in m.neighbors(heavy[0]) if k != atomi]
+            others.sort(key=lambda k: hydrogen[k])
+            refs = heavy + others[:1]
+        else:
+            refs = []
+        hnames = sorted(names[hs].tolist())
+        if(len(hs) == 1):
+            hname = hnames[0]
+        else:
+            hname = hnames[0][:-1]
+            if(hnames != [hname+str(k) for k in range(1,len(hs)+1)]):
+                refs = []
+        if(len(refs) != hdb_nrefs.get(htype)):
+            skipped.append("%s of %s" % (string.join(hnames," "),names[atomi]))
+            continue
+        lines.append("%d   %d   %s\n" % (len(hs),htype,string.join([hname,names[atomi]]+names[refs].tolist()," ")))
+    if(len(skipped) > 0):
+        raise ValueError("no hdb entry for the hydrogens %s of %s (see render_hdb_entry), use --nohdb"
+                % (string.join(skipped,", "),m.name))
+    return "%s %d\n" % (m.name,len(lines)) + string.join(lines,"")
+#-----------------------------------------------------------------------
+def render_marked_block(name,text):
+    return "; BEGIN %s\n%s; END %s\n" % (name,text,name)
+#-----------------------------------------------------------------------
+def find_rows(rows,blockrows):
+    """
+    Returns the positions where the list blockrows is a slice of rows
+    """
+    n = len(blockrows)
+    return [i for i in range(len(rows)-n+1) if rows[i] == blockrows[0] and rows[i:i+n] == blockrows]
+#-----------------------------------------------------------------------
+def get_ff_bonded_tables(fftables,filename,blocksections):
+    """
+    Returns the tables of load_gmx_ffindex() without the entries of
+    blocksections (see read_gmx_sections), the sections of a block of the
+    file filename, and:
+      filesections: the remaining sections of filename (None if it is not
+                    in the tables)
+      blockpos:     dict section -> position of the block entries in
+                    filesections, for the sections where it is known (the
+                    entries are found once)
+    """
+    tables = []
+    filesections = None
+    blockpos = {}
+    for tablefile,sections in fftables:
+        if(tablefile == filename):
+            sections = dict(sections)
+            for name in sections.keys():
+                rows = get_gmx_section([(tablefile,sections)],name)
+                blockrows = blocksections.get(name,[])
+                if(len(blockrows) > 0):
+                    positions = find_rows(rows,blockrows)
+                    if(len(positions) > 0):
+                        rows = rows[:positions[-1]] + rows[positions[-1]+len(blockrows):]
+                    if(len(positions) == 1):
+                        blockpos[name] = positions[0]
+                sections[name] = rows
+            filesections = sections
+        tables.append((tablefile,sections))
+    return tables,filesections,blockpos
+#-----------------------------------------------------------------------
+def inject_molecule(m,parameters,ffdir,hdb=True):
+    """
+    Adds or replaces the residue of the atomgroup m, with the CHARMM
+    parameters of parse_charmm_parameters(), in the force field ffdir (see
+    the header). Without hdb, no .hdb entry is written (a previous one is
+    removed): pdb2gmx then keeps the hydrogens of its input
+
+    Raises ValueError, before any file is modified, if the .hdb entry cannot
+    be written (see render_hdb_entry)
+
+    Returns the number of new bonded types and new atom types
+    """
+    rtptext = render_rtp_residue(m)
+    hdbtext = ""
+    if(hdb):
+        hdbtext = render_hdb_entry(m)
+
+    filename = os.path.join(ffdir,"merged.rtp")
+    splice_block(filename,load_residue_index(filename),get_rtp_blocks,m.name,rtptext)
+
+    filename = os.path.join(ffdir,"merged.hdb")
+    blocks = load_residue_index(filename)
+    if(len(hdbtext) > 0 or m.name in blocks):
+        splice_block(filename,blocks,get_hdb_blocks,m.name,hdbtext)
+
+    # the types already in the force field (tables of the force-field index),
+    # without the previous block of m
+    marker = "; BEGIN " + m.name
+    filename = os.path.abspath(os.path.join(ffdir,"ffbonded.itp"))
+    blocks = load_residue_index(filename,get_marked_blocks)
+    blocksections = parse_gmx_sections(read_block(filename,blocks,marker).splitlines(),{})
+    fftables,filesections,blockpos = get_ff_bonded_tables(load_gmx_ffindex(ffdir,"forcefield.itp"),filename,blocksections)
+    ffparams = bondedparams()
+    ffparams.add_fftables(fftables)
+    duplicates = ffparams.find_duplicates(get_gmx_bonded_sections(parameters))
+    for section,funct,key,status in duplicates:
+        if(status == "conflict"):
+            print "WARNING: [ %s ] %s differs from the force field, the force-field values are kept" \
+                    % (section,string.join(key," "))
+    parameters = remove_duplicate_parameters(parameters,duplicates,True)
+    nparams = sum([len(parameters.get(section,[])) for section in charmm_bonded_sections])
+    text = ""
+    if(nparams > 0 or len(parameters.get("CMAP",[])) > 0):
+        text = render_marked_block(m.name,render_gmx_bon(parameters,""))
+    if(len(text) > 0 or marker in blocks):
+        splice_block(filename,blocks,get_marked_blocks,marker,text)
+        # the tables of the file are updated rather than parsed again: the
+        # entries of a new block go at the end, those of a replaced one where
+        # the old ones were. Where that is not known, the file is parsed again
+        if filesections is not None:
+            for name,rows in parse_gmx_sections(text.splitlines(),{}).items():
+                if marker not in blocks:
+                    filesections.setdefault(name,[]).extend(rows)
+                elif name in blockpos:
+                    pos = blockpos[name]
+                    filesections[name] = filesections[name][:pos] + rows + filesections[name][pos:]
+                else:
+                    filesections = None
+                    break
+            update_gmx_ffindex(ffdir,"forcefield.itp",filename,filesections)
+
+    filename = os.path.join(ffdir,"atomtypes.atp")
+    blocks = load_residue_index(filename,get_atp_blocks)
+    start,end = blocks.get(marker,(0,0))
+    known = set([key for key,(s,e) in blocks.items() if not key.startswith(";") and not (start <= s < end)])
+    newtypes = []
+    for atom in m.atoms:
+        if(atom['type'] not in known):
+            known.add(atom['type'])
+            newtypes.append("%6s %12.5f ; %s\n" % (atom['type'],atom['mass'],m.name))
+            if(atom['mass'] == 0.0):
+                print "WARNING: unknown mass of the atom type",atom['type']
+    if(len(newtypes) > 0 or marker in blocks):
+        text = ""
+        if(len(newtypes) > 0):
+            text = render_marked_block(m.name,string.join(newtypes,""))
+        splice_block(filename,blocks,get_atp_blocks,marker,text)
+    return nparams,len(newtypes)
+#-----------------------------------------------------------------------
+def inject_stream(mol_name,rtp_name,ffdir,hdb=True):
+    """
+    Reads the molecule mol_name of the stream file rtp_name and adds it to
+    the force field ffdir (see inject_molecule())
+    """
+    m = atomgroup()
+    rtplines,prmlines = read_charmm_stream(rtp_name,mol_name)
+    if(len(rtplines) == 0):
+        raise ValueError("RESI %s not found in %s" % (mol_name,rtp_name))
+    # the masses of the types of the molecule, but not from its previous block
+    filename = os.path.join(ffdir,"atomtypes.atp")
+    blocks = load_residue_index(filename,get_atp_blocks)
+    types = set([line.split()[2] for line in rtplines if line.startswith("ATOM")])
+    m.read_charmm_rtp(rtplines,read_atomtypes(filename,blocks,types,blocks.get("; BEGIN " + mol_name,(0,0))))
+    return inject_molecule(m,parse_charmm_parameters(prmlines),ffdir,hdb)
+
+#=================================================================================================================
+
+
+if __name__ == "__main__":
+    hdb = "--nohdb" not in sys.argv
+    if "--nohdb" in sys.argv:
+        sys.argv.remove("--nohdb")
+    if(len(sys.argv) == 5 and sys.argv[1] == "--batch"):
+        jobs = [(name,mol_name,rtp_name) for name,mol_name,mol2_name,rtp_name,outdir in get_batch_jobs(sys.argv[2])]
+    elif(len(sys.argv) == 5):
+        jobs = [(sys.argv[1],sys.argv[1],sys.argv[2])]
+    else:
+        print "Usage: [--nohdb] RESNAME drug.str charmm36.ff newff.ff"
+        print "       [--nohdb] --batch jobs.txt|jobdir charmm36.ff newff.ff"
+        exit()
+    ffdir = sys.argv[3]
+    newffdir = sys.argv[4]
+
+    if not os.path.isdir(newffdir):
+        shutil.copytree(ffdir,newffdir)
+    for name,mol_name,rtp_name in jobs:
+        start = time.time()
+        try:
+            nparams,ntypes = inject_stream(mol_name,rtp_name,newffdir,hdb)
+        except Exception, e:
+            print "%s: FAILED %s: %s" % (name,e.__class__.__name__,e)
+            continue
+        print "%s: %s added to %s, %d new bonded types, %d new atom types (%.2f s)" \
+                % (name,mol_name,newffdir,nparams,ntypes,time.time()-start)
+
+    exit()
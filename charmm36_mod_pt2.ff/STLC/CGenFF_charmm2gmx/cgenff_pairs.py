@@ -0,0 +1,65 @@
+# USAGE: ./cgenff_pairs.py topol.top MOLECULE [pairs.itp]
+# Tested with Python 2.7. Requires cgenff_charmm2gmx.py (numpy)
+
+# Derives the 1-2, 1-3 and 1-4 neighbors of the moleculetype MOLECULE of topol.top from its
+# [ bonds ] (see get_neighbor_pairs() in cgenff_charmm2gmx.py) and compares the 1-4 pairs with the
+# [ pairs ] of the topology, e.g. to cross-check the output of pdb2gmx:
+#   ./cgenff_pairs.py ../../../topol.top Protein_chain_A
+# The pairs of the topology that are not 1-4 neighbors and the 1-4 neighbors missing from the
+# topology are listed. With pairs.itp, the [ pairs ] and [ exclusions ] sections (atoms at most
+# nrexcl bonds apart, nrexcl of the [ moleculetype ]) are written to pairs.itp.
+
+import string
+import sys
+import time
+from cgenff_charmm2gmx import gmxtopology, get_neighbor_pairs, get_exclusions, get_pair_keys, \
+        render_gmx_pairs, render_gmx_exclusions, write_output, np
+
+#-----------------------------------------------------------------------
+def compare_pairs(natoms,pairs,refpairs):
+    """
+    Returns (extra,missing): the (n,2) pairs of refpairs that are not in
+    pairs and the pairs missing from refpairs
+    """
+    keys = get_pair_keys(natoms,pairs)
+    refkeys = get_pair_keys(natoms,refpairs)
+    extra = np.setdiff1d(refkeys,keys)
+    missing = np.setdiff1d(keys,refkeys)
+    return [np.column_stack((k // natoms,k % natoms)).reshape(-1,2) for k in (extra,missing)]
+#-----------------------------------------------------------------------
+def print_pairs(title,pairs,names):
+    for i,j in pairs.tolist():
+        print "%s: %d %s - %d %s" % (title,i+1,names[i],j+1,names[j])
+
+#=================================================================================================================
+
+
+if __name__ == "__main__":
+    if(len(sys.argv) not in (3,4)):
+        print "Usage: topol.top MOLECULE [pairs.itp]"
+        exit()
+    molname = sys.argv[2]
+
+    start = time.time()
+    top = gmxtopology(sys.argv[1])
+    atoms = top.get_atoms(molname)
+    natoms = len(atoms)
+    bonds,funct = top.get_interactions(molname,"bonds")
+    refpairs,funct = top.get_interactions(molname,"pairs")
+    nrexcl = int(top.get_rows(molname,"moleculetype")[0][1])
+    pairs12,pairs13,pairs14 = get_neighbor_pairs(natoms,bonds-1)
+    extra,missing = compare_pairs(natoms,pairs14,refpairs-1)
+
+    print "%s: %d atoms, %d bonds, %d 1-3 and %d 1-4 neighbors, %d [ pairs ] in %s (%.2f s)" \
+            % (molname,natoms,len(pairs12),len(pairs13),len(pairs14),len(refpairs),sys.argv[1],time.time()-start)
+    names = atoms['atom'].tolist()
+    print_pairs("not a 1-4 pair",extra,names)
+    print_pairs("missing 1-4 pair",missing,names)
+    print "%d pairs of %s are not 1-4 neighbors, %d 1-4 neighbors are not in its pairs" % (len(extra),molname,len(missing))
+
+    if(len(sys.argv) == 4):
+        exclusions = get_exclusions(natoms,bonds-1,nrexcl)
+        write_output(sys.argv[3],string.join([render_gmx_pairs(pairs14),render_gmx_exclusions(exclusions)],""))
+        print "%d pairs and %d exclusions (nrexcl %d) written to %s" % (len(pairs14),len(exclusions),nrexcl,sys.argv[3])
+
+    exit()
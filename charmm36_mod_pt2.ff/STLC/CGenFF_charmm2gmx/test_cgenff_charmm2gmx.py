@@ -0,0 +1,52 @@
+# USAGE: python test_cgenff_charmm2gmx.py
+# Tested with Python 2.7
+#
+# Startup budget of cgenff_charmm2gmx.py: importing it must not import numpy nor networkx, and
+# printing its usage (a run with no arguments) must take less than STARTUP_BUDGET seconds, as when a
+# scheduler launches many short conversions. Both are run in a new interpreter, whose own startup is
+# part of the budget.
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+STARTUP_BUDGET = 0.1
+STARTUP_RUNS = 5
+script_dir = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(script_dir,"cgenff_charmm2gmx.py")
+
+#-----------------------------------------------------------------------
+def run_python(args):
+    """
+    Runs the interpreter of the tests with args in the directory of the
+    script; returns its output
+    """
+    p = subprocess.Popen([sys.executable] + args,cwd=script_dir,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    if(p.returncode != 0):
+        raise AssertionError("%s failed:\n%s" % (" ".join(args),out))
+    return out
+
+#=================================================================================================================
+
+class startuptest(unittest.TestCase):
+    def test_import_is_lazy(self):
+        out = run_python(["-c","import sys, cgenff_charmm2gmx; "
+                "print [m for m in ('numpy','networkx','multiprocessing') if m in sys.modules]"])
+        self.assertEqual(out.strip(),"[]")
+    #-----------------------------------------------------------------------
+    def test_usage_startup_budget(self):
+        # the best of a few runs: the budget is for the script, not for a busy machine
+        times = []
+        for i in range(STARTUP_RUNS):
+            start = time.time()
+            out = run_python([script])
+            times.append(time.time() - start)
+            self.assertTrue("Usage" in out,out)
+        self.assertTrue(min(times) < STARTUP_BUDGET,"usage printed in %.3f s, budget %.3f s" % (min(times),STARTUP_BUDGET))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,514 @@
+# USAGE: ./convert_gmx2amber.py nvt.xtc nvt.nc [--chunk NFRAMES] [--nproc N] [--top topol.top --select SELECTION]
+# Tested with Python 2.7 and 3. Requires numpy and xtcreader.py
+#
+# Converts a GROMACS XTC trajectory to an AMBER NetCDF trajectory (coordinates, cell lengths and
+# angles, time), as traj.save_netcdf() of convert_gmx2amber.ipynb, without loading the trajectory:
+# the frames are read by chunks of NFRAMES frames (default 50) which are appended to the NetCDF
+# file, so the memory used is about NFRAMES frames whatever the length of the trajectory.
+# The NetCDF file is written directly (NetCDF 3, 64-bit offsets, as the AMBER programs) and the
+# number of frames in its header is updated after each chunk: an interrupted conversion leaves a
+# valid trajectory of the frames already converted.
+# With --nproc N (0: all the cores), N processes convert contiguous ranges of frames, each writing
+# its frames at their place in the NetCDF file.
+# With --select, only the molecules of SELECTION are converted, e.g. "Protein_chain_A + Other_chain_A2"
+# or "Protein_chain_A + Other_chain_A2 + within 5 of ZZD" (the waters and ions close to the residue
+# ZZD in the first frame), the names being those of the [ molecules ] of topol.top or residue names.
+# The atoms to keep are computed once, and the matching topology is written to nvt.top (its
+# #include of files next to topol.top are rewritten relative to nvt.top).
+# The topology is preprocessed like grompp does (#include, #define, #ifdef, ...), without defines given
+# on the command line; only the [ moleculetype ], [ atoms ] and [ molecules ] sections are read.
+
+from __future__ import print_function, division
+import sys
+import os
+import re
+import struct
+import time
+import multiprocessing
+import numpy as np
+from xtcreader import xtcreader, split_frames
+
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+NC_CHAR = 2
+NC_FLOAT = 5
+NC_DOUBLE = 6
+nc_typecodes = { NC_CHAR:'S1', NC_FLOAT:'>f4', NC_DOUBLE:'>f8' }
+
+# #include "file" line of a topology
+include_re = re.compile(r'^([ \t]*#include[ \t]+")([^"]+)(")',re.M)
+# [ section ] line of a topology
+section_re = re.compile(r'^\[ *([^ \]]+) *\]')
+
+#-----------------------------------------------------------------------
+def pad4(data):
+    return data + b"\0"*(-len(data) % 4)
+#-----------------------------------------------------------------------
+def render_nc_name(name):
+    name = name.encode('ascii')
+    return struct.pack(">i",len(name)) + pad4(name)
+#-----------------------------------------------------------------------
+def render_nc_attributes(attributes):
+    """
+    Returns the NetCDF attribute list of attributes, a list of (name,value)
+    with string or float values
+    """
+    if(len(attributes) == 0):
+        return struct.pack(">ii",0,0)
+    out = [struct.pack(">ii",NC_ATTRIBUTE,len(attributes))]
+    for name,value in attributes:
+        out.append(render_nc_name(name))
+        if isinstance(value,str):
+            value = value.encode('ascii')
+            out.append(struct.pack(">ii",NC_CHAR,len(value)) + pad4(value))
+        else:
+            out.append(struct.pack(">iid",NC_DOUBLE,1,value))
+    return b"".join(out)
+#-----------------------------------------------------------------------
+def get_box_lengths_angles(box):
+    """
+    Returns the lengths (same unit as box) and the angles alpha, beta, gamma
+    (degrees) of the box vectors, the rows of box
+    """
+    lengths = np.sqrt((box*box).sum(axis=-1))
+    angles = np.zeros(lengths.shape)
+    for k,(i,j) in enumerate([(1,2),(0,2),(0,1)]):
+        cos = (box[...,i,:]*box[...,j,:]).sum(axis=-1) / (lengths[...,i]*lengths[...,j])
+        angles[...,k] = np.degrees(np.arccos(np.clip(cos,-1.0,1.0)))
+    return lengths,angles
+
+#=================================================================================================================
+
+class amberncfile(object):
+    """
+    An AMBER NetCDF trajectory open for writing: frames are appended with
+    write_frames(), the file holds all the frames written so far
+    """
+    def __init__(self,filename,natoms,title=""):
+        self.filename = filename
+        self.natoms = natoms
+        self.nframes = 0
+        # dimension name -> (length, 0 for the frames)
+        dimensions = [("frame",0),("spatial",3),("atom",natoms),("cell_spatial",3),("cell_angular",3),("label",5)]
+        # name, type, dimensions, attributes, values of the fixed variables
+        variables = [
+            ("spatial",NC_CHAR,["spatial"],[],b"xyz"),
+            ("cell_spatial",NC_CHAR,["cell_spatial"],[],b"abc"),
+            ("cell_angular",NC_CHAR,["cell_angular","label"],[],b"alphabeta gamma"),
+            ("time",NC_FLOAT,["frame"],[("units","picosecond")],None),
+            ("coordinates",NC_FLOAT,["frame","atom","spatial"],[("units","angstrom")],None),
+            ("cell_lengths",NC_DOUBLE,["frame","cell_spatial"],[("units","angstrom")],None),
+            ("cell_angles",NC_DOUBLE,["frame","cell_angular"],[("units","degree")],None)]
+        attributes = [("title",title),("application","AMBER"),("program",os.path.basename(sys.argv[0])),
+                ("programVersion","1.0"),("Conventions","AMBER"),("ConventionVersion","1.0")]
+
+        # one frame, as stored in the file: the record variables one after the other
+        self.record = np.dtype([(name,nc_typecodes[nctype],tuple([dict(dimensions)[d] for d in dims[1:]]))
+                for name,nctype,dims,attrs,values in variables if values is None])
+
+        # the header is rendered twice: the offsets of the variables depend on its size
+        header = self.render_header(dimensions,attributes,variables,{})
+        offsets = {}
+        offset = len(header)
+        fixed = []
+        for name,nctype,dims,attrs,values in variables:
+            if values is not None:
+                offsets[name] = offset
+                fixed.append(pad4(values))
+                offset += len(fixed[-1])
+        # the record variables of each frame are after the fixed variables
+        self.recordbegin = offset
+        for name in self.record.names:
+            offsets[name] = offset + self.record.fields[name][1]
+        header = self.render_header(dimensions,attributes,variables,offsets)
+
+        self.f = open(filename,'wb')
+        self.f.write(header)
+        self.f.write(b"".join(fixed))
+        self.f.flush()
+    #-----------------------------------------------------------------------
+    def render_header(self,dimensions,attributes,variables,offsets):
+        """
+        Returns the NetCDF header, with no frames, offsets being the byte
+        offsets of the variables
+        """
+        dimids = dict([(name,i) for i,(name,length) in enumerate(dimensions)])
+        out = [b"CDF\x02",struct.pack(">i",0)]
+        out.append(struct.pack(">ii",NC_DIMENSION,len(dimensions)))
+        for name,length in dimensions:
+            out.append(render_nc_name(name) + struct.pack(">i",length))
+        out.append(render_nc_attributes(attributes))
+        out.append(struct.pack(">ii",NC_VARIABLE,len(variables)))
+        for name,nctype,dims,attrs,values in variables:
+            out.append(render_nc_name(name) + struct.pack(">i",len(dims)))
+            out.append(struct.pack(">%di" % len(dims),*[dimids[d] for d in dims]))
+            out.append(render_nc_attributes(attrs))
+            if values is not None:
+                size = len(pad4(values))
+            else:
+                size = self.record.fields[name][0].itemsize
+            out.append(struct.pack(">iiq",nctype,size,offsets.get(name,0)))
+        return b"".join(out)
+    #-----------------------------------------------------------------------
+    def new_frames(self,nframes):
+        """
+        Returns an array of nframes frames to fill and give to write_frames()
+        """
+        return np.zeros(nframes,dtype=self.record)
+    #-----------------------------------------------------------------------
+    def write_frames(self,frames):
+        self.f.seek(self.recordbegin + self.nframes*self.record.itemsize)
+        frames.tofile(self.f)
+        self.set_nframes(self.nframes + len(frames))
+    #-----------------------------------------------------------------------
+    def set_nframes(self,nframes):
+        """
+        Sets the number of frames in the header, e.g. once other processes
+        have written the frames
+        """
+        self.nframes = nframes
+        self.f.seek(4)
+        self.f.write(struct.pack(">i",nframes))
+        self.f.flush()
+    #-----------------------------------------------------------------------
+    def close(self):
+        self.f.close()
+
+#=================================================================================================================
+
+class topmolecules(object):
+    """
+    The molecules of a GROMACS topology: its [ molecules ] and the residue
+    names of the atoms of each moleculetype, what the selections need
+
+    The topology and its #include files (found next to the including file
+    or in GMXLIB) are preprocessed like grompp does: #define, #undef,
+    #ifdef, #ifndef, #else, #endif. The last definition of a moleculetype
+    wins, as in grompp.
+
+    USAGE: top = topmolecules("topol.top")
+           top.molecules                        # [ (name,count) ]
+           top.get_residues("Protein_chain_A")  # residue names of its atoms
+    """
+
+    def __init__(self,filename,defines={}):
+        self.filename = filename
+        self.defines = dict(defines)
+        self.includedirs = []
+        if "GMXLIB" in os.environ:
+            self.includedirs = os.environ["GMXLIB"].split(os.pathsep)
+        self.residues = {}      # moleculetype -> residue names of its atoms
+        self.molecules = []     # [ (name,count) ] of [ molecules ]
+        self.skip = []          # one flag per open #ifdef/#ifndef block
+        self.section = None
+        self.moleculetype = None
+        self.read_file(os.path.abspath(filename))
+        if(len(self.skip) != 0):
+            raise ValueError("topmolecules: missing #endif in %s" % filename)
+
+    #-----------------------------------------------------------------------
+    def find_include(self,name,parentdir):
+        for topdir in [parentdir] + self.includedirs:
+            filename = os.path.join(topdir,name)
+            if os.path.isfile(filename):
+                return os.path.abspath(filename)
+        raise IOError("topmolecules: #include file not found: %s" % name)
+    #-----------------------------------------------------------------------
+    def read_file(self,filename):
+        f = open(filename, 'r')
+        lines = f.read().splitlines()
+        f.close()
+        for line in lines:
+            line = line.split(";")[0].strip()
+            entry = line.split()
+            if(len(entry) == 0):
+                continue
+            if(entry[0] == "#ifdef"):
+                self.skip.append(entry[1] not in self.defines)
+            elif(entry[0] == "#ifndef"):
+                self.skip.append(entry[1] in self.defines)
+            elif(entry[0] == "#else"):
+                self.skip[-1] = not self.skip[-1]
+            elif(entry[0] == "#endif"):
+                self.skip.pop()
+            elif(True in self.skip):
+                pass
+            elif(entry[0] == "#define"):
+                self.defines[entry[1]] = " ".join(entry[2:])
+            elif(entry[0] == "#undef"):
+                self.defines.pop(entry[1],None)
+            elif(entry[0] == "#include"):
+                name = line[len("#include"):].strip().strip("\"<>")
+                self.read_file(self.find_include(name,os.path.dirname(filename)))
+            elif(line[0] == "#"):
+                pass
+            elif(line[0] == "["):
+                match = section_re.match(line)
+                self.section = match.group(1) if match else None
+            elif(self.section == "moleculetype"):
+                self.moleculetype = entry[0]
+                self.residues[self.moleculetype] = []
+                self.section = None
+            elif(self.section == "atoms" and self.moleculetype is not None):
+                self.residues[self.moleculetype].append(entry[3])
+            elif(self.section == "molecules"):
+                self.molecules.append((entry[0],int(entry[1])))
+    #-----------------------------------------------------------------------
+    def get_residues(self,moleculetype):
+        """
+        Returns the residue names of the atoms of moleculetype, as an array
+        """
+        if moleculetype not in self.residues:
+            raise KeyError("topmolecules: no moleculetype %s in %s" % (moleculetype,self.filename))
+        return np.array(self.residues[moleculetype])
+
+#=================================================================================================================
+
+#-----------------------------------------------------------------------
+def read_topology(topname):
+    """
+    Returns the topmolecules of topname
+    """
+    return topmolecules(topname)
+#-----------------------------------------------------------------------
+def get_molecule_blocks(top):
+    """
+    Returns the [ molecules ] of the topmolecules top as a list of
+    (name, index of the first atom, atoms per molecule, number of molecules)
+    """
+    blocks = []
+    start = 0
+    for name,count in top.molecules:
+        natoms = len(top.get_residues(name))
+        blocks.append((name,start,natoms,count))
+        start += natoms*count
+    return blocks
+#-----------------------------------------------------------------------
+def get_reference_atoms(top,blocks,name):
+    """
+    Returns the indices of the atoms of the molecules or residues name
+    """
+    atoms = []
+    for molname,start,natoms,count in blocks:
+        if(molname == name):
+            mask = np.ones(natoms,dtype=bool)
+        else:
+            mask = top.get_residues(molname) == name
+        index = np.nonzero(mask)[0]
+        for k in range(count):
+            atoms.append(start + k*natoms + index)
+    atoms = np.concatenate(atoms) if atoms else np.zeros(0,dtype=np.intp)
+    if(len(atoms) == 0):
+        raise ValueError("no molecule or residue %s in %s" % (name,top.filename))
+    return atoms
+#-----------------------------------------------------------------------
+def select_molecules(top,selection,coords=None,box=None):
+    """
+    Returns the molecules of selection for the topmolecules top: a list of
+    boolean arrays, one per [ molecules ] entry, with a flag per molecule.
+
+    selection is a list of terms separated by "+", each term selecting whole
+    molecules so that the stripped system keeps a valid topology:
+      NAME                     the molecules NAME, or containing the residue NAME
+      within R of NAME         the molecules with an atom closer than R
+                               Angstrom to an atom of NAME, in coords (nm)
+                               with the periodic box (3,3)
+    """
+    blocks = get_molecule_blocks(top)
+    selected = [np.zeros(count,dtype=bool) for name,start,natoms,count in blocks]
+    for term in selection.split("+"):
+        entry = term.split()
+        if(len(entry) == 1):
+            name = entry[0]
+            for i,(molname,start,natoms,count) in enumerate(blocks):
+                if(molname == name or name in top.get_residues(molname)):
+                    selected[i][:] = True
+        elif(len(entry) == 4 and entry[0] == "within" and entry[2] == "of"):
+            if coords is None:
+                raise ValueError("selection %s needs coordinates" % term.strip())
+            cutoff = float(entry[1]) / 10.0
+            ref = coords[get_reference_atoms(top,blocks,entry[3])].astype(np.float64)
+            natoms = sum([n*count for name,start,n,count in blocks])
+            mindist = np.empty(natoms)
+            mindist[:] = np.inf
+            invbox = np.linalg.inv(box)
+            for x in ref:
+                # minimum image distances to the atom x
+                d = coords[:natoms] - x
+                d -= np.dot(np.round(np.dot(d,invbox)),box)
+                np.minimum(mindist,np.sqrt((d*d).sum(axis=1)),out=mindist)
+            for i,(molname,start,n,count) in enumerate(blocks):
+                close = mindist[start:start+n*count].reshape(count,n).min(axis=1) < cutoff
+                selected[i] |= close
+        else:
+            raise ValueError("bad selection: %s" % term.strip())
+    return selected
+#-----------------------------------------------------------------------
+def get_selected_atoms(top,selected):
+    """
+    Returns the indices of the atoms of the molecules of select_molecules()
+    """
+    atoms = []
+    for (name,start,natoms,count),mask in zip(get_molecule_blocks(top),selected):
+        for k in np.nonzero(mask)[0]:
+            atoms.append(np.arange(start+k*natoms,start+(k+1)*natoms))
+    return np.concatenate(atoms) if atoms else np.zeros(0,dtype=np.intp)
+#-----------------------------------------------------------------------
+def rewrite_includes(text,srcdir,outdir):
+    """
+    Returns the topology text of a file of srcdir with its relative
+    #include "file" rewritten relative to outdir. The files that are not
+    found from srcdir (e.g. in GMXLIB) are left as they are
+    """
+    out = []
+    last = 0
+    for match in include_re.finditer(text):
+        name = match.group(2)
+        path = os.path.join(srcdir,name)
+        if(not os.path.isabs(name) and os.path.exists(path)):
+            out.append(text[last:match.start(2)])
+            out.append(os.path.relpath(path,outdir))
+            last = match.end(2)
+    out.append(text[last:])
+    return "".join(out)
+#-----------------------------------------------------------------------
+def write_stripped_top(top,selected,filename):
+    """
+    Writes a copy of the topology of top with the [ molecules ] of
+    select_molecules() only: the selected molecules keep their order, so
+    the topology matches the stripped trajectory. Its relative #include
+    are rewritten for the directory of filename
+    """
+    f = open(top.filename, 'r')
+    data = f.read()
+    f.close()
+    srcdir = os.path.dirname(os.path.abspath(top.filename))
+    outdir = os.path.dirname(os.path.abspath(filename))
+    if(srcdir != outdir):
+        data = rewrite_includes(data,srcdir,outdir)
+    match = re.search(r"^[ \t]*\[ *molecules *\][^\n]*\n",data,re.M)
+    if match is None:
+        raise ValueError("no [ molecules ] in %s" % top.filename)
+    out = [data[:match.end()],"; Compound        #mols\n"]
+    for (name,count),mask in zip(top.molecules,selected):
+        if mask.any():
+            out.append("%-15s %8d\n" % (name,mask.sum()))
+    f = open(filename, 'w')
+    f.write("".join(out))
+    f.close()
+    return
+
+#=================================================================================================================
+
+#-----------------------------------------------------------------------
+def set_frame(frames,n,coords,box,t):
+    """
+    Sets the frame n of frames (amberncfile.new_frames()) from an XTC frame
+    """
+    frames['time'][n] = t
+    # nm -> A
+    np.multiply(coords,10.0,out=frames['coordinates'][n])
+    lengths,angles = get_box_lengths_angles(box.astype(np.float64))
+    frames['cell_lengths'][n] = lengths*10.0
+    frames['cell_angles'][n] = angles
+#-----------------------------------------------------------------------
+def convert_frame_range(args):
+    """
+    Converts the frames range(start,stop) of xtcname into the frames
+    already reserved in the NetCDF file ncname (records of the numpy
+    dtype record from the byte recordbegin), by chunks of chunk frames
+    """
+    xtcname,ncname,atoms,recordbegin,record,start,stop,chunk = args
+    xtc = xtcreader(xtcname,atoms)
+    f = open(ncname,'r+b')
+    frames = np.zeros(min(chunk,stop-start),dtype=record)
+    for first in range(start,stop,chunk):
+        n = min(chunk,stop-first)
+        for k,(coords,box,step,t) in enumerate(xtc.iter_frames(first,first+n)):
+            set_frame(frames,k,coords,box,t)
+        f.seek(recordbegin + first*record.itemsize)
+        frames[:n].tofile(f)
+    f.close()
+    xtc.close()
+    return stop-start
+#-----------------------------------------------------------------------
+def convert_xtc2netcdf(xtcname,ncname,chunk=50,verbose=True,atoms=None,nproc=1):
+    """
+    Converts the XTC trajectory xtcname to the AMBER NetCDF trajectory
+    ncname by chunks of chunk frames, the atoms of the index array atoms
+    only if it is given
+
+    With nproc > 1, the trajectory is split into nproc ranges of frames
+    converted by as many processes, each writing its frames at their place
+    in the NetCDF file; the number of frames is set once all are written
+
+    Returns the number of frames and the conversion rate (frames/s)
+    """
+    start = time.time()
+    xtc = xtcreader(xtcname,atoms)
+    nc = amberncfile(ncname,xtc.natoms if atoms is None else len(atoms),"%s converted by %s" % (os.path.basename(xtcname),os.path.basename(sys.argv[0])))
+    if(nproc > 1):
+        jobs = [(xtcname,ncname,atoms,nc.recordbegin,nc.record,first,last,chunk)
+                for first,last in split_frames(0,xtc.nframes,nproc)]
+        pool = multiprocessing.Pool(nproc)
+        done = 0
+        for n in pool.imap(convert_frame_range,jobs):
+            done += n
+            if verbose:
+                print("%d/%d frames, %.2f frames/s" % (done,xtc.nframes,done/(time.time()-start)))
+        pool.close()
+        pool.join()
+        nc.set_nframes(xtc.nframes)
+    else:
+        frames = nc.new_frames(min(chunk,max(xtc.nframes,1)))
+        n = 0
+        for i,(coords,box,step,t) in enumerate(xtc):
+            set_frame(frames,n,coords,box,t)
+            n += 1
+            if(n == len(frames) or i == xtc.nframes-1):
+                nc.write_frames(frames[:n])
+                n = 0
+                if verbose:
+                    elapsed = time.time() - start
+                    print("%d/%d frames, %.2f frames/s" % (i+1,xtc.nframes,(i+1)/elapsed))
+    nc.close()
+    xtc.close()
+    elapsed = time.time() - start
+    return xtc.nframes,xtc.nframes/elapsed if elapsed > 0 else 0.0
+
+#=================================================================================================================
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {"--chunk":"50","--nproc":"1","--top":None,"--select":None}
+    for option in options:
+        if option in args:
+            i = args.index(option)
+            options[option] = args[i+1]
+            del args[i:i+2]
+    chunk = int(options["--chunk"])
+    nproc = int(options["--nproc"])
+    if(nproc < 1):
+        nproc = multiprocessing.cpu_count()
+    if(len(args) != 2 or chunk < 1 or (options["--select"] is None) != (options["--top"] is None)):
+        print("Usage: nvt.xtc nvt.nc [--chunk NFRAMES] [--nproc N] [--top topol.top --select SELECTION]")
+        exit()
+    xtcname,ncname = args
+    atoms = None
+    if options["--select"] is not None:
+        top = read_topology(options["--top"])
+        coords = box = None
+        if "within" in options["--select"]:
+            # distances in the first frame
+            xtc = xtcreader(xtcname)
+            coords,box,step,t = xtc.read_frame(0)
+            xtc.close()
+        selected = select_molecules(top,options["--select"],coords,box)
+        atoms = get_selected_atoms(top,selected)
+        topname = os.path.splitext(ncname)[0] + ".top"
+        write_stripped_top(top,selected,topname)
+        print("%s: %d atoms selected, stripped topology written to %s" % (options["--select"],len(atoms),topname))
+    nframes,rate = convert_xtc2netcdf(xtcname,ncname,chunk,atoms=atoms,nproc=nproc)
+    print("%s: %d frames written to %s (%.2f frames/s)" % (xtcname,nframes,ncname,rate))
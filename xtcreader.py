@@ -0,0 +1,505 @@
+# USAGE: ./xtcreader.py nvt.xtc [frame]
+# Tested with Python 2.7 and 3. Requires numpy
+#
+# Streaming reader of GROMACS XTC trajectories, written after xdrfile.c (GROMACS 4.x). The frames
+# are decoded one at a time into buffers that are reused for every frame, so the memory used does
+# not depend on the length of the trajectory. Only the run headers of the compressed coordinates
+# are read one by one, the integers are unpacked with numpy (see decode_xtc_coords()).
+# The first time a trajectory is opened, its frames are scanned (only the headers are read) and
+# their byte offsets are saved in the sidecar file trajectory.xtc.idx. Any frame is then read
+# with a single seek. The sidecar is rebuilt when the trajectory changes, and only the new frames
+# are scanned when frames were appended to it (e.g. a running simulation).
+#
+# map_frames() processes the frames with a pool of processes, each decoding a contiguous range of
+# frames, and returns the results in the order of the frames.
+#
+# As a script, prints the number of frames and atoms of the trajectory, and the header and first
+# coordinates of a frame.
+
+from __future__ import print_function, division
+import sys
+import os
+import io
+import struct
+import multiprocessing
+import numpy as np
+
+XTC_MAGIC = 1995
+XTCINDEX_VERSION = 1
+# magic, natoms, step, time, box, natoms
+xtc_header = struct.Struct(">iiif9fi")
+# precision, minint, maxint, smallidx, number of bytes of the compressed coordinates
+xtc_compressed_header = struct.Struct(">f3i3iii")
+
+# sizes of the small integers (xdrfile.c)
+magicints = [0, 0, 0, 0, 0, 0, 0, 0, 0, 8, 10, 12, 16, 20, 25, 32, 40, 50, 64,
+        80, 101, 128, 161, 203, 256, 322, 406, 512, 645, 812, 1024, 1290,
+        1625, 2048, 2580, 3250, 4096, 5060, 6501, 8192, 10321, 13003,
+        16384, 20642, 26007, 32768, 41285, 52015, 65536, 82570, 104031,
+        131072, 165140, 208063, 262144, 330280, 416127, 524287, 660561,
+        832255, 1048576, 1321122, 1664510, 2097152, 2642245, 3329021,
+        4194304, 5284491, 6658042, 8388607, 10568983, 13316085, 16777216]
+FIRSTIDX = 9
+
+#-----------------------------------------------------------------------
+def read_bits(buf,pos,nbits):
+    """
+    Returns the nbits bits of the bytearray buf starting at the bit pos,
+    most significant bit first
+    """
+    end = (pos + nbits + 7) >> 3
+    value = 0
+    for i in range(pos >> 3,end):
+        value = (value << 8) | buf[i]
+    return (value >> ((end << 3) - pos - nbits)) & ((1 << nbits) - 1)
+#-----------------------------------------------------------------------
+def read_ints(buf,pos,nbits,size1,size2):
+    """
+    Returns the three integers packed in the nbits bits of buf starting at
+    the bit pos, the sizes of the last two being size1 and size2. The packed
+    number is stored as 8-bit chunks, least significant chunk first
+    """
+    value = 0
+    shift = 0
+    while(nbits > 8):
+        value |= read_bits(buf,pos,8) << shift
+        pos += 8
+        nbits -= 8
+        shift += 8
+    value |= read_bits(buf,pos,nbits) << shift
+    value,z = divmod(value,size2)
+    x,y = divmod(value,size1)
+    return x,y,z
+#-----------------------------------------------------------------------
+def get_byte_windows(buf):
+    """
+    Returns an int64 array of the 7 bytes of the bytearray buf starting at
+    each byte, most significant first, for read_bits_array()
+    """
+    data = np.frombuffer(buf,dtype=np.uint8).astype(np.int64)
+    n = len(data) - 6
+    windows = data[:n].copy()
+    for k in range(1,7):
+        windows <<= 8
+        windows |= data[k:n+k]
+    return windows
+#-----------------------------------------------------------------------
+def read_bits_array(windows,pos,nbits):
+    """
+    Same as read_bits() for the bit positions pos (an int64 array) of the
+    buffer of windows (see get_byte_windows); nbits (at most 49) may be an
+    array
+    """
+    return (windows[pos >> 3] >> (56 - (pos & 7) - nbits)) & ((np.int64(1) << nbits) - 1)
+#-----------------------------------------------------------------------
+def read_ints_array(windows,pos,nbits,size1,size2):
+    """
+    Same as read_ints() for the bit positions pos of the buffer of windows
+    (see read_bits_array), nbits (at most 63) and the sizes may be arrays.
+    Returns an int64 array (len(pos),3)
+    """
+    value = np.zeros(len(pos),dtype=np.int64)
+    for chunk in range((int(np.max(nbits)) + 7) // 8):
+        value |= read_bits_array(windows,pos+8*chunk,np.clip(nbits-8*chunk,0,8)) << (8*chunk)
+    ints = np.empty((len(pos),3),dtype=np.int64)
+    value,ints[:,2] = np.divmod(value,size2)
+    ints[:,0],ints[:,1] = np.divmod(value,size1)
+    return ints
+#-----------------------------------------------------------------------
+def decode_xtc_coords(buf,natoms,minint,maxint,smallidx,out):
+    """
+    Decodes the compressed coordinates buf of natoms atoms into out, an
+    int32 array (natoms,3) of the coordinates times the precision
+
+    The coordinates are stored as differences to the previous atom in runs of
+    small integers whose size changes along the frame. Only the run headers
+    set where the next integers start: they are read one step (an atom and
+    its run) at a time, then all the integers are unpacked and the runs
+    summed up with numpy
+    """
+    sizeint = [maxint[k] - minint[k] + 1 for k in range(3)]
+    separate = (sizeint[0] | sizeint[1] | sizeint[2]) > 0xffffff
+    if(separate):
+        # large sizes: the three integers are stored separately
+        bitsizeint = [size.bit_length() for size in sizeint]
+        largebits = sum(bitsizeint)
+    else:
+        largebits = (sizeint[0]*sizeint[1]*sizeint[2]).bit_length()
+        if(largebits > 63):
+            return decode_xtc_coords_atoms(buf,natoms,minint,maxint,smallidx,out)
+    smaller = magicints[max(FIRSTIDX,smallidx-1)] // 2
+    smallnum = magicints[smallidx] // 2
+    # bit position and length of the run of each step, and the steps where
+    # the size of the small integers changes: (step, smallidx, smallnum)
+    runpos = []
+    runlen = []
+    changes = [(0,smallidx,smallnum)]
+    pos = 0
+    run = 0
+    i = 0
+    while(i < natoms):
+        pos += largebits
+        # the flag bit and the 5 bits of the run length
+        first = pos >> 3
+        header = (((buf[first] << 8) | buf[first+1]) >> (10 - (pos & 7))) & 63
+        is_smaller = 0
+        if(header & 32):
+            run = header & 31
+            pos += 6
+            is_smaller = run % 3
+            run -= is_smaller
+            is_smaller -= 1
+        else:
+            pos += 1
+        runpos.append(pos)
+        runlen.append(run // 3)
+        pos += (run // 3)*smallidx
+        i += run // 3 + 1
+
+        if(is_smaller != 0):
+            smallidx += is_smaller
+            if(is_smaller < 0):
+                smallnum = smaller
+                if(smallidx > FIRSTIDX):
+                    smaller = magicints[smallidx-1] // 2
+                else:
+                    smaller = 0
+            else:
+                smaller = smallnum
+                smallnum = magicints[smallidx] // 2
+            changes.append((len(runpos),smallidx,smallnum))
+    if(i != natoms):
+        raise ValueError("corrupted XTC frame: %d atoms decoded instead of %d" % (i,natoms))
+
+    changes = np.array(changes,dtype=np.int64)
+    if(changes[:,1].max() > 63):
+        return decode_xtc_coords_atoms(buf,natoms,minint,maxint,changes[0,1],out)
+    runpos = np.array(runpos,dtype=np.int64)
+    nsmall = np.array(runlen,dtype=np.int64)
+    counts = np.diff(np.append(changes[:,0],len(runpos)))
+    sizeidx = np.repeat(changes[:,1],counts)
+    sizenum = np.repeat(changes[:,2],counts)
+    # each step starts where the run of the previous one ends
+    largepos = np.zeros(len(runpos),dtype=np.int64)
+    largepos[1:] = runpos[:-1] + nsmall[:-1]*sizeidx[:-1]
+
+    windows = get_byte_windows(buf)
+    if(separate):
+        large = np.empty((len(runpos),3),dtype=np.int64)
+        pos = largepos
+        for k in range(3):
+            large[:,k] = read_bits_array(windows,pos,bitsizeint[k])
+            pos = pos + bitsizeint[k]
+    else:
+        large = read_ints_array(windows,largepos,largebits,sizeint[1],sizeint[2])
+    large += np.array(minint,dtype=np.int64)
+
+    # the small integers of the runs: differences to the previous atom
+    step = np.repeat(np.arange(len(runpos)),nsmall)
+    runstart = np.cumsum(nsmall) - nsmall
+    k = np.arange(len(step)) - runstart[step]
+    bits = sizeidx[step]
+    sizes = np.array(magicints,dtype=np.int64)[bits]
+    small = read_ints_array(windows,runpos[step] + k*bits,bits,sizes,sizes)
+    small -= sizenum[step][:,None]
+    small = np.cumsum(small,axis=0)
+    small -= np.vstack((np.zeros((1,3),dtype=np.int64),small))[runstart][step]
+    small += large[step]
+
+    # the first atom of a run comes before the atom of its step (better
+    # compression of waters)
+    atomstart = np.cumsum(nsmall+1) - (nsmall+1)
+    out[atomstart + (nsmall > 0)] = large
+    out[atomstart[step] + k + (k > 0)] = small
+    return out
+#-----------------------------------------------------------------------
+def decode_xtc_coords_atoms(buf,natoms,minint,maxint,smallidx,out):
+    """
+    Same as decode_xtc_coords(), atom by atom as
+    xdrfile_decompress_coord_float: for the frames whose integers do not
+    fit in 63 bits
+    """
+    sizeint = [maxint[k] - minint[k] + 1 for k in range(3)]
+    if((sizeint[0] | sizeint[1] | sizeint[2]) > 0xffffff):
+        # large sizes: the three integers are stored separately
+        bitsizeint = [size.bit_length() for size in sizeint]
+        bitsize = 0
+    else:
+        bitsize = (sizeint[0]*sizeint[1]*sizeint[2]).bit_length()
+    minx,miny,minz = minint
+    smaller = magicints[max(FIRSTIDX,smallidx-1)] // 2
+    smallnum = magicints[smallidx] // 2
+    sizesmall = magicints[smallidx]
+    coords = []
+    pos = 0
+    run = 0
+    i = 0
+    while(i < natoms):
+        if(bitsize == 0):
+            x = read_bits(buf,pos,bitsizeint[0])
+            y = read_bits(buf,pos+bitsizeint[0],bitsizeint[1])
+            z = read_bits(buf,pos+bitsizeint[0]+bitsizeint[1],bitsizeint[2])
+            pos += bitsizeint[0] + bitsizeint[1] + bitsizeint[2]
+        else:
+            x,y,z = read_ints(buf,pos,bitsize,sizeint[1],sizeint[2])
+            pos += bitsize
+        prevx = x + minx
+        prevy = y + miny
+        prevz = z + minz
+
+        is_smaller = 0
+        if(read_bits(buf,pos,1)):
+            run = read_bits(buf,pos+1,5)
+            pos += 5
+            is_smaller = run % 3
+            run -= is_smaller
+            is_smaller -= 1
+        pos += 1
+        if(run > 0):
+            for k in range(0,run,3):
+                x,y,z = read_ints(buf,pos,smallidx,sizesmall,sizesmall)
+                pos += smallidx
+                x += prevx - smallnum
+                y += prevy - smallnum
+                z += prevz - smallnum
+                if(k == 0):
+                    # the first two atoms are swapped (better compression of waters)
+                    coords.extend((x,y,z,prevx,prevy,prevz))
+                    i += 2
+                else:
+                    coords.extend((x,y,z))
+                    i += 1
+                prevx,prevy,prevz = x,y,z
+        else:
+            coords.extend((prevx,prevy,prevz))
+            i += 1
+
+        smallidx += is_smaller
+        if(is_smaller < 0):
+            smallnum = smaller
+            if(smallidx > FIRSTIDX):
+                smaller = magicints[smallidx-1] // 2
+            else:
+                smaller = 0
+        elif(is_smaller > 0):
+            smaller = smallnum
+            smallnum = magicints[smallidx] // 2
+        sizesmall = magicints[smallidx]
+    out.flat[:] = coords
+    return out
+#-----------------------------------------------------------------------
+def scan_xtc_offsets(f,offset=0):
+    """
+    Returns the byte offsets of the frames of the XTC file f from offset,
+    reading only the frame headers, and the number of atoms
+    """
+    offsets = []
+    natoms = 0
+    headersize = xtc_header.size + xtc_compressed_header.size
+    filesize = os.fstat(f.fileno()).st_size
+    while True:
+        f.seek(offset)
+        data = f.read(headersize)
+        if(len(data) < xtc_header.size):
+            break
+        header = xtc_header.unpack_from(data)
+        if(header[0] != XTC_MAGIC):
+            raise ValueError("%s: no XTC frame at byte %d" % (f.name,offset))
+        natoms = header[1]
+        if(natoms <= 9):
+            size = xtc_header.size + 12*natoms
+        elif(len(data) < headersize):
+            break
+        else:
+            nbytes = xtc_compressed_header.unpack_from(data,xtc_header.size)[-1]
+            size = headersize + 4*((nbytes + 3) // 4)
+        if(offset + size > filesize):
+            # last frame still being written
+            break
+        offsets.append(offset)
+        offset += size
+    return offsets,natoms
+#-----------------------------------------------------------------------
+def load_xtc_offsets(filename,f):
+    """
+    Returns the frame offsets and the number of atoms of the XTC file
+    filename open as f, from the sidecar filename.idx if it is up to date.
+    The sidecar is (re)written otherwise; when the file only grew, the scan
+    starts at the last known frame
+    """
+    indexfile = filename + ".idx"
+    stat = os.stat(filename)
+    stamp = np.array([XTCINDEX_VERSION,stat.st_mtime,stat.st_size],dtype=np.float64)
+    offsets = []
+    if os.path.exists(indexfile):
+        try:
+            index = np.load(indexfile)
+            if(np.all(index['stamp'] == stamp)):
+                return index['offsets'],int(index['natoms'])
+            if(index['stamp'][0] == stamp[0] and index['stamp'][2] <= stamp[2]):
+                offsets = index['offsets'][:-1].tolist()
+        except (IOError,ValueError,KeyError):
+            offsets = []
+    start = offsets.pop() if offsets else 0
+    try:
+        newoffsets,natoms = scan_xtc_offsets(f,start)
+    except ValueError:
+        # not the same trajectory, scan it again
+        offsets = []
+        newoffsets,natoms = scan_xtc_offsets(f,0)
+    offsets = np.array(offsets+newoffsets,dtype=np.int64)
+    try:
+        tmpfile = "%s.%d" % (indexfile,os.getpid())
+        out = open(tmpfile,'wb')
+        np.savez(out,stamp=stamp,offsets=offsets,natoms=natoms)
+        out.close()
+        os.rename(tmpfile,indexfile)
+    except (IOError,OSError):
+        # read-only directory: the index is not saved
+        pass
+    return offsets,natoms
+
+#=================================================================================================================
+
+class xtcreader(object):
+    """
+    A GROMACS XTC trajectory, read one frame at a time
+
+    read_frame(i) returns the coordinates (natoms,3) in nm, the box (3,3) in
+    nm, the step and the time (ps) of the frame i. The arrays are buffers of
+    the reader that are overwritten by the next frame: copy them to keep them
+
+    With atoms, an array of atom indices, only the coordinates of these
+    atoms are returned (natoms is still the number of atoms of the file)
+    """
+    def __init__(self,filename,atoms=None):
+        self.filename = filename
+        self.f = io.open(filename,'rb')
+        self.offsets,self.natoms = load_xtc_offsets(filename,self.f)
+        self.nframes = len(self.offsets)
+        self.coords = np.zeros((self.natoms,3),dtype=np.float32)
+        self.box = np.zeros((3,3),dtype=np.float32)
+        self.intcoords = np.zeros((self.natoms,3),dtype=np.int32)
+        self.buf = bytearray()
+        self.step = 0
+        self.time = 0.0
+        self.precision = 0.0
+        self.atoms = None
+        if atoms is not None:
+            self.atoms = np.asarray(atoms,dtype=np.intp)
+            self.selected = np.zeros((len(self.atoms),3),dtype=np.float32)
+    #-----------------------------------------------------------------------
+    def get_coords(self):
+        if self.atoms is None:
+            return self.coords
+        return np.take(self.coords,self.atoms,axis=0,out=self.selected)
+    #-----------------------------------------------------------------------
+    def __len__(self):
+        return self.nframes
+    #-----------------------------------------------------------------------
+    def read_frame(self,i):
+        if(i < 0):
+            i += self.nframes
+        if(i < 0 or i >= self.nframes):
+            raise IndexError("frame %d out of range, %s has %d frames" % (i,self.filename,self.nframes))
+        f = self.f
+        f.seek(self.offsets[i])
+        header = xtc_header.unpack(f.read(xtc_header.size))
+        natoms = header[1]
+        if(natoms != self.natoms or header[-1] != natoms):
+            raise ValueError("%s: frame %d has %d atoms instead of %d" % (self.filename,i,natoms,self.natoms))
+        self.step = header[2]
+        self.time = header[3]
+        self.box[:] = np.array(header[4:13]).reshape(3,3)
+        if(natoms <= 9):
+            self.coords[:] = np.frombuffer(f.read(12*natoms),dtype='>f4').reshape(natoms,3)
+            self.precision = 0.0
+            return self.get_coords(),self.box,self.step,self.time
+        compressed = xtc_compressed_header.unpack(f.read(xtc_compressed_header.size))
+        self.precision = compressed[0]
+        nbytes = compressed[-1]
+        # the buffer only grows, with room for the bytes read past the end by read_bits
+        if(len(self.buf) < nbytes + 8):
+            self.buf = bytearray(nbytes + 8)
+        if(f.readinto(memoryview(self.buf)[:nbytes]) != nbytes):
+            raise ValueError("%s: frame %d is truncated" % (self.filename,i))
+        decode_xtc_coords(self.buf,natoms,compressed[1:4],compressed[4:7],compressed[7],self.intcoords)
+        np.multiply(self.intcoords,np.float32(1.0/self.precision),out=self.coords,casting='unsafe')
+        return self.get_coords(),self.box,self.step,self.time
+    #-----------------------------------------------------------------------
+    def iter_frames(self,start=0,stop=None,stride=1):
+        """
+        Yields read_frame(i) for the frames i in range(start,stop,stride)
+        """
+        for i in range(*slice(start,stop,stride).indices(self.nframes)):
+            yield self.read_frame(i)
+    #-----------------------------------------------------------------------
+    def __iter__(self):
+        return self.iter_frames()
+    #-----------------------------------------------------------------------
+    def close(self):
+        self.f.close()
+
+#=================================================================================================================
+
+#-----------------------------------------------------------------------
+def split_frames(start,stop,nranges):
+    """
+    Splits the frames range(start,stop) into at most nranges contiguous
+    ranges (start,stop) of about the same number of frames
+    """
+    bounds = np.linspace(start,stop,nranges+1).round().astype(int)
+    return [(int(first),int(last)) for first,last in zip(bounds[:-1],bounds[1:]) if last > first]
+#-----------------------------------------------------------------------
+def map_frame_range(args):
+    """
+    Returns [func(coords,box,step,time)] for the frames range(start,stop)
+    of filename, opened by this process
+    """
+    func,filename,atoms,start,stop = args
+    xtc = xtcreader(filename,atoms)
+    results = [func(*frame) for frame in xtc.iter_frames(start,stop)]
+    xtc.close()
+    return results
+#-----------------------------------------------------------------------
+def map_frames(func,filename,nproc=1,atoms=None,start=0,stop=None):
+    """
+    Returns [func(coords,box,step,time) for the frames of filename from
+    start to stop], in the order of the frames, computed by nproc processes
+    (all the cores if nproc is None). Each process reads one contiguous range
+    of frames with its own reader (the offsets come from the sidecar), so
+    nothing but the results goes between processes. func must be a module
+    function (pickled) and must copy the arrays it keeps.
+    """
+    xtc = xtcreader(filename)
+    start,stop,stride = slice(start,stop).indices(xtc.nframes)
+    xtc.close()
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    jobs = [(func,filename,atoms,first,last) for first,last in split_frames(start,stop,nproc)]
+    if(nproc > 1):
+        pool = multiprocessing.Pool(nproc)
+        results = pool.map(map_frame_range,jobs,chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = [map_frame_range(job) for job in jobs]
+    return [result for part in results for result in part]
+
+#=================================================================================================================
+
+
+if __name__ == "__main__":
+    if(len(sys.argv) not in (2,3)):
+        print("Usage: nvt.xtc [frame]")
+        exit()
+    xtc = xtcreader(sys.argv[1])
+    print("%s: %d frames of %d atoms" % (sys.argv[1],xtc.nframes,xtc.natoms))
+    if(len(sys.argv) == 3):
+        coords,box,step,time = xtc.read_frame(int(sys.argv[2]))
+        print("frame %s: step %d, time %.3f ps, precision %g" % (sys.argv[2],step,time,xtc.precision))
+        print("box (nm):")
+        print(box)
+        print("first atoms (nm):")
+        print(coords[:5])
+    xtc.close()